@@ -1,11 +1,17 @@
 from dt_scpi_lib.ieee488 import ieee488_t, scpi_t
 from dt_scpi_lib.sig_gen import fake_sig_gen, scpi_sig_gen, hmct2220, hp8648, smbv100a, smw200a
 from dt_scpi_lib.spec_ana import agilent_8563, e4440
-from dt_scpi_lib.substrate import prologix_tty, gpib_device, dummy_substrate, usbtty, usbtmc, socket_comm, log, stderr_log
+from dt_scpi_lib.substrate import prologix_tty, gpib_bus, gpib_device, dummy_substrate, usbtty, usbtmc, socket_comm, log, stderr_log, substrate_timeout, block_progress, block_capture, readblock_to
 from dt_scpi_lib.vna import hp8720d
 from dt_scpi_lib.oscilloscope import oscilloscope_t, rigol_ds1000z_t, tektronix_tds, dsox1204a
 from dt_scpi_lib.power_meter import u2020_t
 from dt_scpi_lib.power_supply import power_supply_t, thurlby_pl330, n6700, n6780a, e36300
 from dt_scpi_lib.fakes import fet_emulator, fake_customer_dut
 from dt_scpi_lib.multimeter import keithley2110
-from dt_scpi_lib.parameter import constant_t, lockable_parameter_t, frequency_t
+from dt_scpi_lib.parameter import constant_t, lockable_parameter_t, frequency_t, state_cache, verify_failed, lock_failed
+from dt_scpi_lib.async_substrate import async_prologix_tty, async_gpib_device, async_usbtty, async_usbtmc, async_socket_comm
+from dt_scpi_lib.trace import trace_file, trace_recorder, trace_reader, replay_substrate
+from dt_scpi_lib.simulator import latency_model, sim_instrument, sim_substrate, sim_server, sim_pty
+from dt_scpi_lib.metrics import command_metrics
+from dt_scpi_lib.batch import write_batch, query_many
+from dt_scpi_lib.sweep import sweep_t, acquisition, fixed_settle, step_settle, opc_settle
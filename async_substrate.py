@@ -0,0 +1,311 @@
+import asyncio
+import os
+import socket
+import serial
+from dt_scpi_lib.substrate import fakelog, usbtmc
+
+# asyncio counterparts of the classes in substrate.py.
+# Every I/O method is a coroutine and takes an optional timeout (in seconds) that overrides the object's default,
+# so that independent instruments can be driven concurrently with asyncio.gather(), and a call that overruns its
+# deadline raises asyncio.TimeoutError. Objects must be opened with "await x.open()" before use.
+
+
+async def _deadline(coro, timeout):
+    if timeout is None:
+        return await coro
+    return await asyncio.wait_for(coro, timeout)
+
+
+async def _open_tty(f):
+    # pyserial configures the port; asyncio then reads and writes the file descriptor directly
+    port = serial.Serial(f)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    rfile = os.fdopen(os.dup(port.fileno()), "rb", buffering=0)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), rfile)
+    wfile = os.fdopen(os.dup(port.fileno()), "wb", buffering=0)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, wfile)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return port, reader, writer
+
+
+async def _readblock(reader):
+    # IEEE 488.2 block: '#', the number of length digits, the length, then the data
+    c = await reader.readexactly(1)
+    if c != b'#':
+        raise RuntimeError("The device did not respond with a valid IEEE block")
+    digits = int(await reader.readexactly(1))
+    if digits == 0:
+        return bytearray((await reader.readuntil(b"\n"))[:-1])
+    length = int(await reader.readexactly(digits))
+    return bytearray(await reader.readexactly(length))
+
+
+class async_prologix_tty(object):
+    # One of these per Prologix adapter. Whole write+read transactions are serialised by a lock,
+    # so async_gpib_device objects on different addresses can share the adapter safely.
+    # When a call times out, the adapter may still pass on the answer it was waiting for; the next call first
+    # throws away everything that arrives until the adapter has been quiet for longer than its own read timeout.
+    def __init__(self, f, log=None, timeout=None, read_tmo=0.5):
+        self.f = f
+        self.addr = None
+        self.timeout = timeout
+        self.read_tmo = read_tmo
+        self._resync = False
+        self.lock = asyncio.Lock()
+        self.log = log
+        if not self.log:
+            self.log = fakelog()
+
+    async def open(self):
+        self.port, self.reader, self.writer = await _open_tty(self.f)
+        self.addr = None
+        self._resync = False
+        for s in ["++mode 1", "++ifc", "++read_tmo_ms %u" % (self.read_tmo * 1000), "++eoi 1", "++eos 2"]:
+            await self.dwrite(s)
+        return self
+
+    async def dwrite(self, string):
+        self.log.command("\n" + string + "\n")
+        self.writer.write(("\n" + string + "\n").encode())
+        await self.writer.drain()
+
+    async def _write(self, addr, string):
+        if self.addr != addr:
+            await self.dwrite("++addr %u" % addr)
+            self.addr = addr
+        self.writer.write(string.encode())
+        self.log.command(string)
+        await self.writer.drain()
+
+    async def _read(self, addr, mode):
+        if addr is not None and self.addr != addr:
+            await self.dwrite("++addr %u" % addr)
+            self.addr = addr
+        await self.dwrite("++read " + mode)
+        # As in prologix_tty: if nothing has arrived by the time the adapter has given up, nothing will.
+        # Only the first byte is waited for with the adapter's timeout, so a long answer isn't cut short.
+        try:
+            first = await asyncio.wait_for(self.reader.readexactly(1), self.read_tmo + 0.1)
+        except asyncio.TimeoutError:
+            self.log.remark("no answer within %g seconds" % self.read_tmo)
+            return ""
+        line = first if first == b"\n" else first + await self.reader.readline()
+        a = line.rstrip().decode()
+        self.log.response(a)
+        return a
+
+    async def _drain(self):
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(65536), self.read_tmo + 0.1)
+            except asyncio.TimeoutError:
+                return
+            if not data:
+                return
+            self.log.remark("Discarding %r, which arrived after its call timed out" % data)
+
+    async def _transaction(self, timeout, fn, *args):
+        async with self.lock:
+            if self._resync:
+                await self._drain()
+                self._resync = False
+            try:
+                return await _deadline(fn(*args), timeout or self.timeout)
+            except asyncio.TimeoutError:
+                self._resync = True
+                raise
+
+    async def write(self, addr, string, timeout=None):
+        await self._transaction(timeout, self._write, addr, string)
+
+    async def read_eoi(self, addr=None, timeout=None):
+        return await self._transaction(timeout, self._read, addr, "eoi")
+
+    async def read_lf(self, addr=None, timeout=None):
+        return await self._transaction(timeout, self._read, addr, "10")
+
+    async def _query(self, addr, string):
+        await self._write(addr, string)
+        return await self._read(addr, "eoi")
+
+    async def query(self, addr, string, timeout=None):
+        return await self._transaction(timeout, self._query, addr, string)
+
+    def close(self):
+        self.writer.close()
+        self.port.close()
+
+
+class async_gpib_device(object):
+    def __init__(self, substrate, address, eol="", log=None):
+        self.serial = substrate
+        self.address = address
+        self.log = log
+        self.eol = eol
+        if not self.log:
+            self.log = fakelog()
+
+    async def write(self, string, timeout=None):
+        self.log.command(string)
+        await self.serial.write(self.address, string + self.eol, timeout=timeout)
+
+    async def readline(self, timeout=None):
+        return await self.serial.read_eoi(self.address, timeout=timeout)
+
+    async def read(self, string, timeout=None):
+        self.log.command(string)
+        return await self.serial.query(self.address, string + self.eol, timeout=timeout)
+
+
+class async_usbtty(object):
+    def __init__(self, f, log=None, timeout=None):
+        self.f = f
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        self.log = log
+        if not self.log:
+            self.log = fakelog()
+
+    async def open(self):
+        self.port, self.reader, self.writer = await _open_tty(self.f)
+        return self
+
+    async def write(self, string, timeout=None):
+        self.log.command(string)
+        self.writer.write((string + "\n").encode())
+        await _deadline(self.writer.drain(), timeout or self.timeout)
+
+    async def readline(self, timeout=None):
+        a = (await _deadline(self.reader.readline(), timeout or self.timeout)).rstrip().decode()
+        self.log.response(a)
+        return a
+
+    async def read(self, string, timeout=None):
+        async with self.lock:
+            await self.write(string, timeout)
+            return await self.readline(timeout)
+
+    def close(self):
+        self.writer.close()
+        self.port.close()
+
+
+class async_socket_comm(object):
+    # There's no telling when an instrument will get round to an answer that a timed-out call gave up on, so after
+    # a read times out, the connection refuses to be used until it has been opened again.
+    def __init__(self, host, port, log=None, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        self._skip_terminator = False
+        self.broken = False
+        self.log = log
+        if not self.log:
+            self.log = fakelog()
+
+    async def open(self):
+        if getattr(self, "writer", None) is not None:
+            self.writer.close()
+        self.reader, self.writer = await _deadline(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._skip_terminator = False
+        self.broken = False
+        return self
+
+    async def _receive(self, coro, timeout):
+        if self.broken:
+            coro.close()
+            raise ConnectionError("An earlier read from %s:%u timed out, so the responses may be out of step; open() it again"
+                                  % (self.host, self.port))
+        try:
+            return await _deadline(coro, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.broken = True
+            raise
+
+    async def write(self, string, timeout=None):
+        self.log.command(string)
+        self.writer.write((string + "\r\n").encode())
+        await _deadline(self.writer.drain(), timeout or self.timeout)
+
+    async def _readline(self):
+        a = await self.reader.readline()
+        if self._skip_terminator:
+            # The newline that followed the last IEEE block
+            self._skip_terminator = False
+            if not a.strip():
+                a = await self.reader.readline()
+        return a.decode().rstrip()
+
+    async def readline(self, timeout=None):
+        a = await self._receive(self._readline(), timeout)
+        self.log.response(a)
+        return a
+
+    async def read(self, string, timeout=None):
+        async with self.lock:
+            await self.write(string, timeout)
+            return await self.readline(timeout)
+
+    async def readblock(self, timeout=None):
+        data = await self._receive(_readblock(self.reader), timeout)
+        self._skip_terminator = True
+        self.log.remark("Fetched a %u byte block" % len(data))
+        return data
+
+    def close(self):
+        self.writer.close()
+
+
+class async_usbtmc(object):
+    # The usbtmc character device is an ordinary file, so the blocking substrate runs in an executor thread.
+    # A timed-out call gives up waiting, but the thread itself carries on until the device answers, and the
+    # lock is held until it does, so that the next call can't start while the device is still busy with the last.
+    # The thread's reads time out after the default timeout too, so it does finish if the device never answers.
+    def __init__(self, devpath, log=None, eol="\n", timeout=None, executor=None):
+        self.sync = usbtmc(devpath, log=log, eol=eol, timeout=timeout or 0)
+        self.log = self.sync.log
+        self.timeout = timeout
+        self.executor = executor
+        self.lock = asyncio.Lock()
+
+    async def open(self):
+        return self
+
+    async def _run(self, timeout, fn, *args):
+        # Waiting for the lock counts against the deadline too
+        return await _deadline(self._locked_run(fn, *args), timeout or self.timeout)
+
+    async def _locked_run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        await self.lock.acquire()
+        try:
+            future = loop.run_in_executor(self.executor, fn, *args)
+        except BaseException:
+            self.lock.release()
+            raise
+        future.add_done_callback(self._finished)
+        return await asyncio.shield(future)
+
+    def _finished(self, future):
+        self.lock.release()
+        if not future.cancelled() and future.exception() is not None:
+            # Nobody may be waiting for it any more
+            self.log.remark("usbtmc call failed: %s" % future.exception())
+
+    async def write(self, cmd, timeout=None):
+        await self._run(timeout, self.sync.write, cmd)
+
+    async def read(self, cmd, timeout=None):
+        return await self._run(timeout, self.sync.read, cmd)
+
+    async def readline(self, timeout=None):
+        return await self._run(timeout, self.sync.readline)
+
+    async def readblock(self, timeout=None):
+        return await self._run(timeout, self.sync.readblock)
+
+    def close(self):
+        self.sync.close()
@@ -0,0 +1,162 @@
+import contextlib
+from dt_scpi_lib.scpi_parse import split_units
+
+# Write coalescing.
+#
+#   with write_batch(scope.substrate):
+#       scope.trigger_edge(scope.channel1, scope.rising)
+#       scope.channel_scale(scope.channel1, 0.5)
+#
+# sends one ":TRIGger:MODe EDGE;:TRIGger:EDGe:SOURce CHANnel1;...;:CHANnel1:SCALe 0.500000V" message
+# instead of four. Inside the block the substrate's write() only collects commands; they are sent when
+# the block ends, when they would overflow max_bytes, or just before anything is read. A query made with
+# read() goes out in the same message as the writes collected before it. If the block raises, whatever
+# is still collected is dropped rather than sent.
+#
+# The drivers don't need to know: the batch swaps the substrate object's own write/read methods for the
+# duration, so it applies to every user of that substrate, on every thread.
+
+
+class write_batch(object):
+    # separator: what goes between commands; ";" for SCPI.
+    # absolute:  put a ":" in front of commands that don't have one (or a "*"), so that each command is
+    #            taken from the root of the command tree rather than relative to the one before it.
+    #            Turn this off for instruments that don't speak SCPI, such as the HP 8720D.
+    # max_bytes: the most to put in one message; defaults to the substrate's max_message attribute (all the
+    #            substrates in substrate.py have one), or no limit if it has none.
+    methods = ["write", "read", "readline", "readblock", "readblock_to", "read_raw", "spoll"]
+
+    def __init__(self, substrate, separator=";", absolute=True, max_bytes=None):
+        self.substrate = substrate
+        self.separator = separator
+        self.absolute = absolute
+        self.max_bytes = max_bytes if max_bytes is not None else getattr(substrate, "max_message", None)
+        self.pending = []
+        self.size = 0
+        self.outer = None
+        self.originals = {}
+        self.replaced = {}
+        self.messages = 0
+
+    def _unit(self, command):
+        units = split_units(command)
+        if self.absolute:
+            units = [u if u.startswith((":", "*")) else ":" + u for u in units]
+        return self.separator.join(units)
+
+    def _join(self, commands):
+        return self.separator.join(commands)
+
+    def write(self, command):
+        unit = self._unit(command)
+        if not unit:
+            return
+        if self.max_bytes and self.pending and self.size + len(self.separator) + len(unit) > self.max_bytes:
+            self.flush()
+        self.pending.append(unit)
+        self.size += len(unit) + (len(self.separator) if len(self.pending) > 1 else 0)
+
+    def flush(self):
+        if self.pending:
+            message = self._join(self.pending)
+            self.pending = []
+            self.size = 0
+            self.messages += 1
+            self.originals["write"](message)
+
+    def read(self, command):
+        # The query goes out with the commands collected before it, through the substrate's own write() and
+        # readline(): its read() may call write(), which is the batch's while the batch is open
+        self.write(command)
+        transaction = getattr(self.substrate, "transaction", None)
+        with transaction() if transaction else contextlib.nullcontext():
+            self.flush()
+            return self.originals["readline"]()
+
+    def readline(self):
+        self.flush()
+        return self.originals["readline"]()
+
+    def readblock(self):
+        self.flush()
+        return self.originals["readblock"]()
+
+    def readblock_to(self, *args, **kwargs):
+        self.flush()
+        return self.originals["readblock_to"](*args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        self.flush()
+        return self.originals["read_raw"](*args, **kwargs)
+
+    def spoll(self, *args):
+        # The status byte should reflect the commands collected so far
+        self.flush()
+        return self.originals["spoll"](*args)
+
+    def __enter__(self):
+        self.outer = getattr(self.substrate, "_write_batch", None)
+        if self.outer is not None:
+            # Already batching; the outer batch collects everything
+            return self.outer
+        for name in self.methods:
+            if hasattr(self.substrate, name):
+                self.originals[name] = getattr(self.substrate, name)
+                self.replaced[name] = self.substrate.__dict__.get(name)
+                setattr(self.substrate, name, getattr(self, name))
+        self.substrate._write_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.outer is not None:
+            return False
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            for name, method in self.replaced.items():
+                if method is None:
+                    delattr(self.substrate, name)
+                else:
+                    setattr(self.substrate, name, method)
+            del self.substrate._write_batch
+        return False
+
+
+def query_many(substrate, queries, compound=True, absolute=True, max_bytes=None):
+    # Sends several queries as one compound message ("SOUR1:FREQ?;:POW?;:OUTP?") and splits the
+    # semicolon-separated response back into one string per query. Queries are sent in as many messages
+    # as max_bytes requires (by default the substrate's max_message, if it has one). If the number of
+    # answers doesn't match the number of queries, or compound=False, they are asked one at a time.
+    if not compound:
+        return [substrate.read(q) for q in queries]
+    if max_bytes is None:
+        max_bytes = getattr(substrate, "max_message", None)
+
+    def unit(q):
+        q = q.strip().rstrip(";").strip()
+        return q if not absolute or q.startswith((":", "*")) else ":" + q
+
+    chunks = [[]]
+    size = 0
+    for q in queries:
+        u = unit(q)
+        if max_bytes and chunks[-1] and size + 1 + len(u) > max_bytes:
+            chunks.append([])
+            size = 0
+        size += len(u) + (1 if chunks[-1] else 0)
+        chunks[-1].append(u)
+
+    values = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if len(chunk) == 1:
+            values.append(substrate.read(chunk[0]))
+            continue
+        answers = split_units(substrate.read(";".join(chunk)))
+        if len(answers) != len(chunk):
+            substrate.log.remark("compound query got %u answers for %u queries; asking one at a time" % (len(answers), len(chunk)))
+            answers = [substrate.read(q) for q in chunk]
+        values.extend(answers)
+    return values
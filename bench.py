@@ -0,0 +1,309 @@
+from __future__ import print_function
+import os
+import json
+import platform
+import argparse
+import itertools
+import time
+import struct
+import array
+import tracemalloc
+from dt_scpi_lib.substrate import socket_comm, prologix_tty, gpib_device, usbtty, usbtmc
+from dt_scpi_lib.simulator import sim_instrument, sim_substrate, sim_pty, sim_server
+from dt_scpi_lib.parameter import parameter_t, memoizing_parameter_t
+
+# Benchmarks for the transports and drivers, using stand-ins that run on this machine:
+# simulated instruments behind a TCP server and pseudo-terminals, and a mocked pyusb endpoint.
+# Run it with "python -m dt_scpi_lib.bench", and add "--json results.json" to keep the numbers.
+
+
+def latency_stats(latencies, total=None):
+    # Summary of a list of per-operation times in seconds
+    ordered = sorted(latencies)
+    n = len(ordered)
+    if total is None:
+        total = sum(ordered)
+
+    def percentile(p):
+        return ordered[min(n - 1, int(p / 100.0 * n))] * 1e6
+
+    return {
+        "count": n,
+        "seconds": total,
+        "ops_per_s": n / total if total else None,
+        "mean_us": total / n * 1e6,
+        "p50_us": percentile(50),
+        "p90_us": percentile(90),
+        "p99_us": percentile(99),
+        "max_us": ordered[-1] * 1e6,
+    }
+
+
+def time_each(fn, count):
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for i in range(count):
+        t = clock()
+        fn()
+        latencies.append(clock() - t)
+    return latency_stats(latencies, clock() - start)
+
+
+def block_server():
+    # A simulated instrument on 127.0.0.1, where "BLOCk? <n>" gets an IEEE block of n bytes
+    inst = sim_instrument()
+    inst.handler("BLOCk?", lambda i, args: bytes(int(args)))
+    return sim_server(inst, realtime=False)
+
+
+def bench_socket_queries(port, count=2000, **kwargs):
+    s = socket_comm("127.0.0.1", port, **kwargs)
+    try:
+        return time_each(lambda: s.read("*IDN?"), count)
+    finally:
+        s.close()
+
+
+def bench_socket_blocks(port, size=4 * 1024 * 1024, count=10, **kwargs):
+    s = socket_comm("127.0.0.1", port, **kwargs)
+    try:
+        start = time.perf_counter()
+        for i in range(count):
+            s.write("BLOCk? %u" % size)
+            data = s.readblock()
+            assert len(data) == size
+        elapsed = time.perf_counter() - start
+    finally:
+        s.close()
+    return {"bytes": size * count, "seconds": elapsed, "mb_per_s": size * count / elapsed / 1e6}
+
+
+class fake_bulk_endpoints(object):
+    # Stands in for the pyusb bulk endpoints of a USBTMC device.
+    # Every DEV_DEP_MSG_IN request is answered from `payload`, in transfers no bigger than the requested size.
+    def __init__(self, payload):
+        self.payload = memoryview(payload)
+        self.offset = 0
+        self.requested = 0
+        self.written = 0
+        self.out = self._out(self)
+        self.inp = self._in(self)
+
+    class _out(object):
+        def __init__(self, parent):
+            self.parent = parent
+
+        def write(self, data, timeout=None):
+            p = self.parent
+            msgid, = struct.unpack_from("B", data)
+            if msgid == 2:
+                p.requested, = struct.unpack_from("<L", data, 4)
+            else:
+                p.written += len(data)
+            return len(data)
+
+    class _in(object):
+        def __init__(self, parent):
+            self.parent = parent
+            self.header = struct.Struct("<BBBxLBxxx")
+
+        def read(self, size_or_buffer, timeout=None):
+            # Like pyusb: given a size, return a new array; given an array, fill it and return the count
+            if isinstance(size_or_buffer, int):
+                buffer = array.array("B", bytes(size_or_buffer))
+                return buffer[:self.read(buffer)]
+            buffer = size_or_buffer
+            p = self.parent
+            size = min(p.requested, len(p.payload) - p.offset)
+            eom = p.offset + size == len(p.payload)
+            self.header.pack_into(buffer, 0, 2, 1, 0xFE, size, eom)
+            view = memoryview(buffer)
+            view[12:12 + size] = p.payload[p.offset:p.offset + size]
+            p.offset = 0 if eom else p.offset + size
+            return 12 + size
+
+
+def _measure(fn, count):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    for i in range(count):
+        fn()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_usbtmc_instrument(size=8 * 1024 * 1024, count=10):
+    # Compares the allocating and the preallocated bulk paths of usbtmc.Instrument
+    from dt_scpi_lib.usbtmc import Instrument
+
+    payload = bytes(size)
+    ep = fake_bulk_endpoints(payload)
+    inst = Instrument(device=object())
+    inst.bulk_in_ep, inst.bulk_out_ep = ep.inp, ep.out
+    inst.connected = True
+    buf = bytearray(size)
+    results = {}
+    try:
+        for name, fn in [("read_raw", lambda: inst.read_raw()),
+                         ("read_raw_into", lambda: inst.read_raw_into(buf)),
+                         ("write_raw", lambda: inst.write_raw(payload)),
+                         ("write_raw_from", lambda: inst.write_raw_from(buf))]:
+            fn()  # warm up, so that the kept packet buffers are not counted
+            elapsed, peak = _measure(fn, count)
+            results[name] = {"mb_per_s": size * count / elapsed / 1e6, "peak_alloc_bytes": peak}
+    finally:
+        inst.connected = False
+    return results
+
+
+def bench_prologix(count=1000):
+    # One adapter with two instruments; the second run alternates between them to include "++addr" switches
+    sim = sim_pty({5: sim_instrument(idn="five"), 7: sim_instrument(idn="seven")}, realtime=False)
+    tty = prologix_tty(sim.path)
+    a, b = gpib_device(tty, 5), gpib_device(tty, 7)
+    devices = itertools.cycle([a, b])
+    try:
+        same = time_each(lambda: a.read("*IDN?"), count)
+        alternating = time_each(lambda: next(devices).read("*IDN?"), count)
+    finally:
+        tty.file.close()
+        sim.close()
+    return {"same_address": same, "alternating_address": alternating}
+
+
+def bench_usbtty(count=1000):
+    sim = sim_pty(sim_instrument(), realtime=False)
+    tty = usbtty(sim.path)
+    try:
+        return time_each(lambda: tty.read("*IDN?"), count)
+    finally:
+        tty.serial.close()
+        sim.close()
+
+
+def bench_usbtmc_file(count=1000, size=1024 * 1024, blocks=10):
+    # usbtmc on a pseudo-terminal standing in for /dev/usbtmcN
+    inst = sim_instrument()
+    inst.handler("BLOCk?", lambda i, args: bytes(size))
+    sim = sim_pty(inst, realtime=False)
+    # Opened unbuffered, as a device file would be, so that usbtmc reads the file descriptor with a deadline
+    dev = os.fdopen(os.open(sim.path, os.O_RDWR | os.O_NOCTTY), "r+b", buffering=0)
+    s = usbtmc(dev, timeout=5)
+    try:
+        queries = time_each(lambda: s.read("*IDN?"), count)
+        start = time.perf_counter()
+        for i in range(blocks):
+            s.write("BLOCk?")
+            assert len(s.readblock()) == size
+        elapsed = time.perf_counter() - start
+    finally:
+        dev.close()
+        sim.close()
+    return {"queries": queries, "blocks": {"bytes": size * blocks, "seconds": elapsed, "mb_per_s": size * blocks / elapsed / 1e6}}
+
+
+class _bench_parent(object):
+    def __init__(self, substrate):
+        self.substrate = substrate
+
+
+def bench_parameters(count=20000):
+    # Driver-side cost of the parameter classes, against a simulator that answers instantly
+    parent = _bench_parent(sim_substrate(sim_instrument(), realtime=False))
+    p = parameter_t(parent, lambda hz: "SOUR1:FREQ %dHz; " % hz, getter="SOUR1:FREQ?")
+    m = memoizing_parameter_t(parent, lambda db: "pow %f; " % db, getter="pow?")
+    return {
+        "parameter_t.set": time_each(lambda: p.set(1e9), count),
+        "parameter_t.get": time_each(p.get, count),
+        "memoizing_parameter_t.set": time_each(lambda: m.set(-10), count),
+        "memoizing_parameter_t.get": time_each(m.get, count),
+    }
+
+
+def bench_drivers(count=5000):
+    from dt_scpi_lib.power_meter import u2020_t
+    from dt_scpi_lib.sig_gen import smw200a
+    from dt_scpi_lib.oscilloscope import dsox1204a
+    from dt_scpi_lib.multimeter import keithley2110
+
+    inst = sim_instrument()
+    inst.handler("READ1?", lambda i, args: "-10.5")
+    inst.handler("READ?", lambda i, args: "+1.234E+00")
+    inst.handler("MEASure:VAMPlitude?", lambda i, args: "+2.5E-01")
+    s = sim_substrate(inst, realtime=False)
+    meter = u2020_t(s)
+    sig = smw200a(s)
+    scope = dsox1204a(s)
+    dmm = keithley2110(s)
+
+    def set_frequency():
+        sig.frequency.hz = 1e9
+
+    return {
+        "sim_substrate.read": time_each(lambda: s.read("*IDN?"), count),
+        "u2020_t.read": time_each(lambda: meter.read(1), count),
+        "smw200a.frequency.hz": time_each(set_frequency, count),
+        "dsox1204a.amplitude": time_each(lambda: scope.amplitude(scope.channel1), count),
+        "keithley2110.dc_voltage": time_each(dmm.dc_voltage, count),
+    }
+
+
+def _flatten(prefix, results, out):
+    for name, r in sorted(results.items()):
+        if isinstance(r, dict) and not any(isinstance(v, (int, float)) for v in r.values()):
+            _flatten(prefix + name + ".", r, out)
+        else:
+            out[prefix + name] = r
+    return out
+
+
+def run_all(scale=1.0):
+    n = lambda count: max(10, int(count * scale))
+    results = {}
+    server = block_server()
+    try:
+        results["socket_comm.queries"] = bench_socket_queries(server.port, n(2000))
+        results["socket_comm.blocks"] = bench_socket_blocks(server.port, count=n(10))
+    finally:
+        server.close()
+    results["prologix_tty"] = bench_prologix(n(1000))
+    results["usbtty"] = bench_usbtty(n(1000))
+    results["usbtmc"] = bench_usbtmc_file(n(1000), blocks=n(10))
+    try:
+        results["usbtmc.Instrument"] = bench_usbtmc_instrument(count=n(10))
+    except ImportError:
+        pass  # pyusb is not installed
+    results["parameters"] = bench_parameters(n(20000))
+    results["drivers"] = bench_drivers(n(5000))
+    return _flatten("", results, {})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dt_scpi_lib transports and drivers")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the number of iterations by this")
+    args = parser.parse_args(argv)
+
+    results = run_all(args.scale)
+    for name, r in sorted(results.items()):
+        if "mb_per_s" in r:
+            print("%-45s %10.1f MB/s" % (name, r["mb_per_s"]))
+        else:
+            print("%-45s %10.0f ops/s   p50 %8.1f us   p99 %8.1f us" % (name, r["ops_per_s"], r["p50_us"], r["p99_us"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "time": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
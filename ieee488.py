@@ -3,9 +3,16 @@ import sys
 import os
 import time
 from dt_scpi_lib.parameter import *
+from dt_scpi_lib.batch import write_batch, query_many
+from dt_scpi_lib.substrate import substrate_timeout
 
 class ieee488_t(object):
     # IEEE-488.2 - http://rfmw.em.keysight.com/rfcomms/refdocs/gsm/hpib_common.html
+    # Set to False in drivers for instruments that can't answer several queries in one message
+    compound_queries = True
+    # Set to False in drivers for instruments that don't speak SCPI, so batches don't put ":" in front of commands
+    absolute_headers = True
+
     def __init__(self):
         self.idn = constant_t(self, "*IDN?")
         self.opt = constant_t(self, "*OPT?")
@@ -21,9 +28,97 @@ class ieee488_t(object):
 
     def rst(self):
         self.substrate.write("*RST")
+        self.invalidate_state()
+
+    def enable_state_cache(self, ttl=None):
+        # Lets this instrument's memoizing parameters skip writes that wouldn't change anything; see parameter.py
+        self.state_cache = state_cache(ttl)
+        return self.state_cache
+
+    def invalidate_state(self):
+        # Call after anything that changes settings behind the parameters' backs (reset, recall, preset)
+        cache = getattr(self, "state_cache", None)
+        if cache is not None:
+            cache.invalidate()
 
     def stbQ(self):
-        return self.substrate.write("*STB?")
+        return self.substrate.read("*STB?")
+
+    # Standard event status register and status byte bits
+    esr_operation_complete = 0x01
+    stb_event_status = 0x20
+
+    def wait_complete(self, method="opc", timeout=10.0, poll=0.001, max_poll=0.1, command=None, done="1"):
+        # Waits until the instrument has finished what it was last told to do (a sweep, say), and no longer.
+        #   "opc":   asks *OPC? (or command, which may start the operation too, eg. "OPC?;SING;" on HP instruments),
+        #            which the instrument answers once it has finished. This needs reads that time out (prologix_tty's
+        #            always do; give usbtmc and socket_comm a timeout), or the deadline can't be kept.
+        #   "esr":   sends *OPC, then polls *ESR? until the operation complete bit is set
+        #   "stb":   sends *ESE 1 and *OPC, then serial polls (or asks *STB?) until the event status bit is set
+        #   "query": asks command (eg. "DONE?") until the answer is done; for instruments that aren't IEEE-488.2
+        # Polls start poll seconds apart and back off to max_poll. Raises substrate_timeout after timeout seconds.
+        substrate = getattr(self, "substrate", None) or self.gpib
+        deadline = time.monotonic() + timeout
+        interval = poll
+
+        def pause():
+            nonlocal interval
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise substrate_timeout("The instrument did not finish within %g seconds" % timeout)
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, max_poll)
+
+        def answer(read, *args):
+            # A read that times out before the instrument replies either comes back empty (on a Prologix adapter)
+            # or raises; either way the question is still pending, so it's read again rather than asked again
+            try:
+                return read(*args)
+            except TimeoutError:
+                return ""
+
+        if method == "opc":
+            a = answer(substrate.read, command or "*OPC?")
+            while not a.strip():
+                pause()
+                a = answer(substrate.readline)
+        elif method == "query":
+            a = answer(substrate.read, command)
+            while a.strip() != done:
+                pause()
+                a = answer(substrate.readline) if not a.strip() else answer(substrate.read, command)
+        elif method == "esr":
+            substrate.write("*OPC")
+            while not int(substrate.read("*ESR?")) & self.esr_operation_complete:
+                pause()
+        elif method == "stb":
+            substrate.write("*ESE %u;*OPC" % self.esr_operation_complete)
+            spoll = getattr(substrate, "spoll", None) or (lambda: int(substrate.read("*STB?")))
+            while not spoll() & self.stb_event_status:
+                pause()
+            substrate.read("*ESR?")
+        else:
+            raise ValueError("Unknown way of waiting: %s" % method)
+
+    def batch(self, **kwargs):
+        # Collects this instrument's writes into as few messages as possible; see batch.py
+        substrate = getattr(self, "substrate", None) or self.gpib
+        kwargs.setdefault("absolute", self.absolute_headers)
+        return write_batch(substrate, **kwargs)
+
+    def query_many(self, queries, **kwargs):
+        # One round trip for several queries, where the instrument allows it; see batch.py
+        substrate = getattr(self, "substrate", None) or self.gpib
+        kwargs.setdefault("compound", self.compound_queries)
+        kwargs.setdefault("absolute", self.absolute_headers)
+        return query_many(substrate, queries, **kwargs)
+
+    def identify(self):
+        # Fetches *IDN?, *OPT? and *SRE? together, and keeps them for the constant parameters
+        constants = [self.idn, self.opt, self.sre]
+        for c, value in zip(constants, self.query_many([c.getter for c in constants])):
+            c.remember(value)
+        return [c.value for c in constants]
 
 
 class scpi_t(ieee488_t):
@@ -37,5 +132,9 @@ class scpi_t(ieee488_t):
     def system_version(self):
         return self.gpib.read("SYSTem:VERSion?")
 
+    def preset(self):
+        self.substrate.write("SYSTem:PRESet")
+        self.invalidate_state()
+
     def close(self):
         self.substrate.close()
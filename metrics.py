@@ -0,0 +1,155 @@
+import threading
+import time
+import functools
+from dt_scpi_lib.scpi_parse import normalize_header
+
+# Per-command timing for the substrates.
+#
+# Give a substrate a command_metrics object (metrics=...) and it will time every command it sends,
+# keyed by the name of the instrument and the normalised header of the command ("MEAS:VOLT?" for
+# "MEASure:VOLTage? (@1)"). A command that is not a query is timed from the start of the write to the
+# end of the write; a query is timed from the start of the write to the end of its response.
+
+
+@functools.lru_cache(maxsize=4096)
+def command_header(command):
+    if isinstance(command, (bytes, bytearray)):
+        command = bytes(command).decode(errors="replace")
+    return normalize_header(command)
+
+
+class latency_histogram(object):
+    # Log-linear buckets in the manner of HdrHistogram. Values (in nanoseconds) below 2**bits are kept
+    # exactly, and larger ones to within one part in 2**(bits-1), whatever their size.
+    def __init__(self, bits=6):
+        self.bits = bits
+        self.reset()
+
+    def reset(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+    def _bucket(self, value):
+        e = value.bit_length()
+        if e <= self.bits:
+            return value
+        shift = e - self.bits
+        return (shift << self.bits) + (value >> shift)
+
+    def _value(self, bucket):
+        # The middle of the range of values that fall into a bucket
+        if bucket < (1 << self.bits):
+            return bucket
+        shift = bucket >> self.bits
+        mantissa = bucket & ((1 << self.bits) - 1)
+        return (mantissa << shift) + (1 << (shift - 1))
+
+    def record(self, ns):
+        ns = int(ns)
+        b = self._bucket(ns)
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.total += ns
+        if self.minimum is None or ns < self.minimum:
+            self.minimum = ns
+        if self.maximum is None or ns > self.maximum:
+            self.maximum = ns
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        wanted = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= wanted:
+                return min(max(self._value(b), self.minimum), self.maximum)
+        return self.maximum
+
+
+class command_stats(object):
+    def __init__(self):
+        self.histogram = latency_histogram()
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+
+    def snapshot(self):
+        h = self.histogram
+        us = lambda ns: None if ns is None else ns / 1000.0
+        return {
+            "count": h.count,
+            "total_s": h.total / 1e9,
+            "mean_us": us(h.total / h.count) if h.count else None,
+            "min_us": us(h.minimum),
+            "p50_us": us(h.percentile(50)),
+            "p90_us": us(h.percentile(90)),
+            "p99_us": us(h.percentile(99)),
+            "max_us": us(h.maximum),
+            "tx_bytes": self.tx_bytes,
+            "rx_bytes": self.rx_bytes,
+        }
+
+
+class command_metrics(object):
+    # Can be shared by any number of substrates and threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, instrument, command, ns, tx_bytes=0, rx_bytes=0):
+        key = (instrument, command_header(command))
+        with self.lock:
+            s = self.stats.get(key)
+            if s is None:
+                s = self.stats[key] = command_stats()
+            s.histogram.record(ns)
+            s.tx_bytes += tx_bytes
+            s.rx_bytes += rx_bytes
+
+    def probe(self, instrument):
+        return substrate_probe(self, instrument)
+
+    def snapshot(self, reset=False):
+        # One dict per (instrument, command), the ones that took the most time in total first
+        with self.lock:
+            rows = []
+            for (instrument, command), s in self.stats.items():
+                row = s.snapshot()
+                row["instrument"] = instrument
+                row["command"] = command
+                rows.append(row)
+            if reset:
+                self.stats = {}
+        rows.sort(key=lambda r: r["total_s"], reverse=True)
+        return rows
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+
+class substrate_probe(object):
+    # What a substrate holds on to: it remembers the outstanding query between the write and the response
+    def __init__(self, metrics, instrument):
+        self.metrics = metrics
+        self.instrument = instrument
+        self.pending = None
+
+    def start(self):
+        return time.perf_counter_ns()
+
+    def sent(self, command, nbytes, started):
+        if command_header(command).endswith("?"):
+            self.pending = (command, nbytes, started)
+        else:
+            self.metrics.record(self.instrument, command, time.perf_counter_ns() - started, tx_bytes=nbytes)
+
+    def received(self, nbytes):
+        if self.pending is None:
+            return
+        command, tx, started = self.pending
+        self.pending = None
+        self.metrics.record(self.instrument, command, time.perf_counter_ns() - started, tx_bytes=tx, rx_bytes=nbytes)
@@ -4,6 +4,11 @@ import os
 import time
 from dt_scpi_lib.ieee488 import ieee488_t, scpi_t
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class multimeter_t(object):
 
     def run():
@@ -21,10 +26,39 @@ class multimeter_t(object):
         raise NotImplementedError
 
 class keithley2110(scpi_t):
+    # Measurement functions, and the subsystem whose range goes with them
+    dc_volts = ("VOLTage:DC", "VOLT")
+    ac_volts = ("VOLTage:AC", "VOLT")
+    dc_amps = ("CURRent:DC", "CURR")
+    ac_amps = ("CURRent:AC", "CURR")
 
     def __init__(self, f):
         self.gpib = f
-   
+        self.substrate = f
+        self.mconfig = {}
+
+    def invalidate_state(self):
+        # After a reset (or recall), nothing is known about how the meter is set up
+        self.mconfig = {}
+        super().invalidate_state()
+
+    def configure(self, function, samples=1, triggers=1):
+        # Only sends the settings that differ from what the meter was last told, so that measuring the same
+        # thing over and over doesn't switch function and autorange each time
+        name, subsystem = function
+        wanted = [("function", function, ['FUNCtion "%s"' % name, '%s:RANGe:AUTO 1' % subsystem]),
+                  ("samples", samples, ["SAMPle:COUNt %u" % samples]),
+                  ("triggers", triggers, ["TRIGger:COUNt %u" % triggers])]
+        for key, value, commands in wanted:
+            if self.mconfig.get(key) != value:
+                for c in commands:
+                    self.gpib.write(c)
+                self.mconfig[key] = value
+
+    def measure(self, function):
+        self.configure(function)
+        return float(self.gpib.read("READ?"))
+
     def display(self, message):
         self.gpib.write(":DISPlay:TEXT \"%s\"" % message)
 
@@ -35,24 +69,32 @@ class keithley2110(scpi_t):
         self.gpib.write(":DISPlay %u" % (1 if onoff else 0))
 
     def dc_voltage(self):
-        self.gpib.write('FUNCtion "VOLTage:DC"')
-        self.gpib.write('VOLT:RANGe:AUTO 1')
-        return float(self.gpib.read("READ?"))
+        return self.measure(self.dc_volts)
 
     def ac_voltage(self):
-        self.gpib.write('FUNCtion "VOLTage:AC"')
-        self.gpib.write('VOLT:RANGe:AUTO 1')
-        return float(self.gpib.read("READ?"))
+        return self.measure(self.ac_volts)
 
     def dc_current(self):
-        self.gpib.write('FUNCtion "CURRent:DC"')
-        self.gpib.write('CURR:RANGe:AUTO 1')
-        return float(self.gpib.read("READ?"))
+        return self.measure(self.dc_amps)
 
     def ac_current(self):
-        self.gpib.write('FUNCtion "CURRent:AC"')
-        self.gpib.write('CURR:RANGe:AUTO 1')
-        return float(self.gpib.read("READ?"))
+        return self.measure(self.ac_amps)
+
+    def burst(self, samples, triggers=1, function=None, timeout=60.0):
+        # Takes samples readings per trigger, for triggers immediate triggers, and fetches them all with one FETCh?.
+        # function defaults to whatever was measured last (or DC volts). Returns a numpy array if numpy is installed.
+        if function is None:
+            function = self.mconfig.get("function", self.dc_volts)
+        self.configure(function, samples, triggers)
+        if self.mconfig.get("trigger_source") != "IMM":
+            self.gpib.write("TRIGger:SOURce IMMediate")
+            self.mconfig["trigger_source"] = "IMM"
+        self.gpib.write("INITiate")
+        self.wait_complete("opc", timeout)
+        readings = self.gpib.read("FETCh?").split(",")
+        if numpy is not None:
+            return numpy.array(readings, dtype=numpy.float64)
+        return [float(r) for r in readings]
 
     def system_error(self):
         return float(self.gpib.read(":SYSTem:ERRor?"))
@@ -2,8 +2,40 @@ from collections import namedtuple
 import sys
 import os
 import time
+import array
 from dt_scpi_lib.ieee488 import ieee488_t, scpi_t
 from dt_scpi_lib.parameter import *
+from dt_scpi_lib.substrate import block_capture
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The fields of :WAVeform:PREamble?, in order
+preamble_t = namedtuple("preamble_t", ["format", "type", "points", "count", "xincrement", "xorigin", "xreference",
+                                       "yincrement", "yorigin", "yreference"])
+
+
+def parse_preamble(string):
+    fields = [float(f) for f in string.split(",")]
+    return preamble_t(*([int(f) for f in fields[:4]] + fields[4:]))
+
+
+def scale_waveform(data, preamble, dtype):
+    # Turns the raw samples from :WAVeform:DATA? into (seconds, volts), as numpy arrays if numpy is installed
+    p = preamble
+    if numpy is not None:
+        raw = numpy.frombuffer(data, dtype=dtype)
+        volts = (raw.astype(numpy.float64) - p.yreference) * p.yincrement + p.yorigin
+        seconds = (numpy.arange(len(raw)) - p.xreference) * p.xincrement + p.xorigin
+        return seconds, volts
+    raw = array.array("B" if dtype == "u1" else "H", bytes(data))
+    if dtype == "<u2" and sys.byteorder != "little":
+        raw.byteswap()
+    volts = [(r - p.yreference) * p.yincrement + p.yorigin for r in raw]
+    seconds = [(i - p.xreference) * p.xincrement + p.xorigin for i in range(len(raw))]
+    return seconds, volts
 
 
 class oscilloscope_t(object):
@@ -92,6 +124,60 @@ class rigol_ds1000z_t(oscilloscope_t):
     def amplitude(self):
         return self.substrate.read(":MEASure:VAMPlitude?")
 
+    # The most points one :WAVeform:DATA? will return in BYTE format
+    max_chunk = 250000
+
+    def memory_depth(self):
+        # Points in each channel's memory, or None if the scope chooses for itself (it answers "AUTO")
+        a = self.substrate.read(":ACQuire:MDEPth?").strip()
+        if a.upper() == "AUTO":
+            return None
+        return int(float(a))
+
+    def deep_memory_preamble(self, channel):
+        # Stops the scope and selects the whole of a channel's memory, one byte per point
+        assert(self.is_channel(channel))
+        self.stop()
+        # One command per message; the DS1000Z doesn't take compound ones
+        self.substrate.write(":WAVeform:SOURce %s" % channel)
+        self.substrate.write(":WAVeform:MODE RAW")
+        self.substrate.write(":WAVeform:FORMat BYTE")
+        preamble = parse_preamble(self.substrate.read(":WAVeform:PREamble?"))
+        # The transfer is sized from the memory depth where it is set, rather than trusting the preamble to report all of it
+        depth = self.memory_depth()
+        return preamble._replace(points=depth) if depth else preamble
+
+    def deep_memory_chunks(self, channel, chunk=None, preamble=None):
+        # Yields (offset, bytes) for each chunk of the channel's memory in turn, so only one chunk is held at a time.
+        # Points are numbered from 1 on the scope, and offsets from 0 here.
+        if preamble is None:
+            preamble = self.deep_memory_preamble(channel)
+        chunk = min(chunk or self.max_chunk, self.max_chunk)
+        for start in range(0, preamble.points, chunk):
+            stop = min(start + chunk, preamble.points)
+            self.substrate.write(":WAVeform:STARt %u" % (start + 1))
+            self.substrate.write(":WAVeform:STOP %u" % stop)
+            self.substrate.write(":WAVeform:DATA?")
+            yield start, self.substrate.readblock()
+
+    @staticmethod
+    def scale(raw, preamble):
+        # The DS1000Z's own formula, which isn't quite the same as Keysight's
+        return (raw - preamble.yorigin - preamble.yreference) * preamble.yincrement
+
+    def deep_memory(self, channel, filename, volts=False, chunk=None):
+        # Reads the whole of a channel's memory into a .npy file, which is returned memory-mapped along with the preamble.
+        # The raw bytes are kept unless volts=True, which stores float32 volts (four times the size).
+        if numpy is None:
+            raise ImportError("deep_memory needs numpy; use deep_memory_chunks without it")
+        preamble = self.deep_memory_preamble(channel)
+        out = numpy.lib.format.open_memmap(filename, mode="w+", dtype=numpy.float32 if volts else numpy.uint8, shape=(preamble.points,))
+        for offset, data in self.deep_memory_chunks(channel, chunk, preamble):
+            raw = numpy.frombuffer(data, dtype=numpy.uint8)
+            out[offset:offset + len(raw)] = self.scale(raw.astype(numpy.float32), preamble) if volts else raw
+        out.flush()
+        return out, preamble
+
 class dsox1204a(oscilloscope_t, ieee488_t):
     # It's true; this oscilloscope has some SCPI-like language, but actually is not SCPI.
     # And it also does not accept most IEEE-488.2 commands either
@@ -109,6 +195,9 @@ class dsox1204a(oscilloscope_t, ieee488_t):
     falling = "NEG"
     rising_falling = "EITHer"
 
+    byte = "BYTE"
+    word = "WORD"
+
     def __init__(self, substrate):
         self.substrate = substrate
         self.idn = constant_t(self, "*IDN?")
@@ -126,27 +215,65 @@ class dsox1204a(oscilloscope_t, ieee488_t):
             return float(string)
 
     def ieee_block_bytes(self):
-        # TODO: The programming examples in the datasheet (written in some flavor of VBA) call this function "DoQueryIEEEBlock_Bytes"
-        # which hints at the possibility that this format belongs in some IEEE standard. If that's the case, then this method ought to be moved to a superclass
-
-        # The first byte is an ASCII character '1' thru '9', which is the length of the length, and the next 1 to 9 bytes are the
-        # length. So if the block is 100 bytes long, then because 100 is a three-digit number the first four bytes in the block are
-        # "3100". This scheme effectively limits the block length to just shy of 10 kilobytes; have I misunderstood something?
-        i = int(self.substrate.get_byte())
-        length = 0
-        for i in range(0, i):
-            length = length * 10 + int(self.substrate.get_byte())
-        self.substrate.remark("Fetching a %u byte block" % length)
-
-        for l in range(0, l):
-            yield self.substrate(get_byte())
-
-    def screenshot(self, filename):
+        # The programming examples in the datasheet (written in some flavor of VBA) call this function "DoQueryIEEEBlock_Bytes";
+        # it's an IEEE-488.2 definite length block: "#", one digit giving the number of digits in the length, then the length,
+        # then the data. That allows for up to 999999999 bytes, and the substrate knows how to read it.
+        return self.substrate.readblock()
+
+    def waveform_format(self, fmt):
+        # Samples are unsigned, in either format; WORD ones are sent least significant byte first, which is how the host wants them
+        self.substrate.write(":WAVeform:FORMat %s" % fmt)
+        self.substrate.write(":WAVeform:UNSigned 1")
+        if fmt == self.word:
+            self.substrate.write(":WAVeform:BYTeorder LSBFirst")
+        self.mwaveform_format = fmt
+
+    def invalidate_state(self):
+        # After a reset, the scope is back to its own idea of the waveform format
+        self.__dict__.pop("mwaveform_format", None)
+        super().invalidate_state()
+
+    # The format field of the preamble; ASCii (4) isn't a block of samples
+    preamble_dtypes = {0: "u1", 1: "<u2"}
+
+    def waveform_points(self, points, mode="RAW"):
+        # mode is NORMal (what's on screen), MAXimum or RAW (the whole acquisition record, when stopped)
+        self.substrate.write(":WAVeform:POINts:MODE %s" % mode)
+        self.substrate.write(":WAVeform:POINts %u" % points)
+
+    def waveform_preamble(self, channel=None):
+        if channel is not None:
+            assert(self.is_channel(channel))
+            self.substrate.write(":WAVeform:SOURce %s" % channel)
+        return parse_preamble(self.substrate.read(":WAVeform:PREamble?"))
+
+    def waveform(self, channel, fmt=None):
+        # Fetches a channel's waveform as one block and returns (seconds, volts).
+        # The format is set the first time (BYTE, unless fmt says otherwise), since the scope may have been left in any of them,
+        # and the samples are read according to what the preamble says they are.
+        current = getattr(self, "mwaveform_format", None)
+        if current is None or (fmt is not None and fmt != current):
+            self.waveform_format(fmt or self.byte)
+        preamble = self.waveform_preamble(channel)
+        if preamble.format not in self.preamble_dtypes:
+            raise RuntimeError("The oscilloscope is sending waveforms in an unexpected format (%u)" % preamble.format)
+        self.substrate.write(":WAVeform:DATA?")
+        data = self.ieee_block_bytes()
+        return scale_waveform(data, preamble, self.preamble_dtypes[preamble.format])
+
+    def waveforms(self, channels, fmt=None, digitize=False):
+        # Several channels in one go; with digitize=True they are first captured together with :DIGitize, which leaves the scope stopped.
+        # Returns a dictionary of channel to (seconds, volts)
+        if digitize:
+            self.substrate.write(":DIGitize %s" % ",".join(channels))
+        return dict((c, self.waveform(c, fmt)) for c in channels)
+
+    def screenshot(self, filename, background=False, callback=None):
+        # Streams the PNG to the file and returns the block_capture; with background=True, wait() for it
+        # before using the scope again
         self.substrate.write(":HARDcopy:INKSaver OFF")
         self.substrate.write(":DISPlay:DATA? PNG, COLor")
-        data = self.substrate.readblock()
-        with open(filename, "w+b") as scrshot:
-            scrshot.write(data)
+        return block_capture(self.substrate, filename, callback, background)
 
     def channel_autoscale(self, channel):
         assert(self.is_channel(channel))
@@ -1,7 +1,11 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import sys
 import os
+import re
 import time
+import asyncio
+import threading
+import concurrent.futures
 
 class parameter_t(object):
     """
@@ -28,6 +32,18 @@ class parameter_t(object):
         self.boundscheck(value)
         self.parent.substrate.write(self.setter(value))
 
+    # Counterparts of query/get/set for instruments whose substrate comes from async_substrate.py
+    async def aquery(self):
+        return await self.parent.substrate.read(self.getter)
+
+    async def aget(self):
+        self.value = await self.aquery()
+        return self.value
+
+    async def aset(self, value):
+        self.boundscheck(value)
+        await self.parent.substrate.write(self.setter(value))
+
     def __str__(self):
         return self.get()
 
@@ -36,32 +52,200 @@ class parameter_t(object):
             self.set(val)
         return self.get()
 
+class state_cache(object):
+    """
+    Instrument-wide bookkeeping for the memoizing parameters of one instrument.
+    With one of these as the instrument's state_cache attribute (see
+    ieee488_t.enable_state_cache), a memoizing parameter skips the write when it
+    is set to the value it already has. Everything it remembers is forgotten
+    when the generation is bumped, which *RST, *RCL and presets do, and,
+    if ttl is given, once it is more than ttl seconds old, in case someone has
+    been at the front panel.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+
+    def fresh(self, generation, stamp):
+        if generation != self.generation:
+            return False
+        return self.ttl is None or time.monotonic() - stamp < self.ttl
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"generation": self.generation, "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / float(total) if total else None}
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
 class memoizing_parameter_t(parameter_t):
 
     def __init__(self, parent, setter, getter=None):
         super().__init__(parent, setter, getter)
         self.ready = False
+        self.generation = None
+        self.stamp = None
+
+    @property
+    def cache(self):
+        return getattr(self.parent, "state_cache", None)
+
+    def known(self):
+        # Whether self.value can be trusted without asking the instrument
+        if not self.ready:
+            return False
+        cache = self.cache
+        return cache is None or cache.fresh(self.generation, self.stamp)
+
+    def remember(self, value):
+        cache = self.cache
+        self.value = value
+        self.ready = True
+        self.generation = cache.generation if cache is not None else None
+        self.stamp = time.monotonic()
+
+    def _lookup(self):
+        known = self.known()
+        cache = self.cache
+        if cache is not None:
+            cache.count(known)
+        return known
+
+    def _unchanged(self, value):
+        # Only skip writes when there is a cache; without one every set() goes to the instrument, as it always has
+        cache = self.cache
+        if cache is None:
+            return False
+        unchanged = self.known() and self.value == value
+        cache.count(unchanged)
+        return unchanged
 
     def get(self):
-        if self.ready:
-            return self.value
-        else:
-            super().get()
-            self.ready = True
-            return self.value
+        if not self._lookup():
+            self.remember(self.query())
+        return self.value
 
     def set(self, value):
-        self.ready = True
-        self.value = value
+        if self._unchanged(value):
+            return
+        self.ready = False
         super().set(value)
+        self.remember(value)
+
+    async def aget(self):
+        if not self._lookup():
+            self.remember(await self.aquery())
+        return self.value
+
+    async def aset(self, value):
+        if self._unchanged(value):
+            return
+        self.ready = False
+        await super().aset(value)
+        self.remember(value)
+
+class verify_failed(Exception):
+    def __init__(self, parameter, wanted, got):
+        super().__init__("%r was set to %r but reads back as %r" % (parameter.getter, wanted, got))
+        self.wanted = wanted
+        self.got = got
+
+number = re.compile(r"^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)")
+
+def parse_number(response):
+    # "+1.000000E+09" -> 1e9, "5Hz" -> 5.0; None if it doesn't start with a number
+    m = number.match(response)
+    return float(m.group(1)) if m else None
 
 class requerying_parameter_t(parameter_t):
-    # Some instruments don't actually set the thing until you query it. 
+    # Some instruments don't actually set the thing until you query it.
     # We may never know why
+    # So set() writes the value, reads it back, and writes it again until the two agree, at most retries more
+    # times, sleeping backoff seconds (doubling each time) in between; then it raises verify_failed.
+    # Numbers agree if they are within tolerance, or half of resolution, of each other; anything else is
+    # compared as a string. With opc=True the write is followed by *OPC? in the same message instead of the
+    # read-back, for instruments where that's enough to make the setting stick.
+    # Either way, value is what was set; the instrument's own answer is kept in readback.
+    def __init__(self, parent, setter, getter=None, tolerance=0, resolution=None, retries=3, backoff=0.01, opc=False):
+        super().__init__(parent, setter, getter)
+        self.tolerance = tolerance
+        self.resolution = resolution
+        self.retries = retries
+        self.backoff = backoff
+        self.opc = opc
+        self.readback = None
+
+    def matches(self, value, response):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            got = parse_number(response)
+            if got is None:
+                return False
+            slack = max(self.tolerance, self.resolution / 2.0 if self.resolution else 0)
+            return abs(got - value) <= slack
+        return response.strip().strip('"').lower() == str(value).strip().lower()
+
+    def _opc_command(self, value):
+        return self.setter(value).strip().rstrip(";").strip() + ";*OPC?"
+
     def set(self, value):
-        while super().query() != value: # Fix for some instruments that don't always
-            self.super().substrate.write(self.setter(value))
-        self.value = self.query()
+        self.boundscheck(value)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            if self.opc:
+                response = self.parent.substrate.read(self._opc_command(value))
+                if response.strip().startswith("1"):
+                    self.value = value
+                    return
+            else:
+                self.parent.substrate.write(self.setter(value))
+                response = self.query()
+                if self.matches(value, response):
+                    self.value = value
+                    self.readback = response
+                    return
+        raise verify_failed(self, value, response)
+
+    async def aset(self, value):
+        self.boundscheck(value)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay *= 2
+            if self.opc:
+                response = await self.parent.substrate.read(self._opc_command(value))
+                if response.strip().startswith("1"):
+                    self.value = value
+                    return
+            else:
+                await self.parent.substrate.write(self.setter(value))
+                response = await self.aquery()
+                if self.matches(value, response):
+                    self.value = value
+                    self.readback = response
+                    return
+        raise verify_failed(self, value, response)
 
 
 class constant_t(memoizing_parameter_t):
@@ -71,6 +255,13 @@ class constant_t(memoizing_parameter_t):
     def set(self, value):
         raise Exception("This parameter cannot be set")
 
+    async def aset(self, value):
+        raise Exception("This parameter cannot be set")
+
+    def known(self):
+        # Constants survive resets, so the state cache doesn't apply
+        return self.ready
+
     def get(self):
         return super().get()
 
@@ -78,6 +269,13 @@ class integer_constant_t(constant_t):
     def get(self):
         return int(super().get())
 
+class lock_failed(Exception):
+    # errors is a list of (member, exception), one for each member of a lockable_parameter_t that failed
+    def __init__(self, errors):
+        # (Never str(member): for a parameter, that's a query)
+        super().__init__("; ".join("%s: %r" % (getattr(l, "getter", None) or repr(l), e) for l, e in errors))
+        self.errors = errors
+
 class lockable_parameter_t(parameter_t):
     """
     Use in client code that needs to set a parameter on several instruments at
@@ -90,13 +288,24 @@ class lockable_parameter_t(parameter_t):
     trigger, and then assign a frequency to it by calling set(something). This
     last operation will assign the frequency to all the others, taking care of
     bounds checking, device quirks, and what have you.
+    Members on different buses are set at the same time, from a thread pool;
+    members that share a bus (the same substrate, or the same Prologix
+    adapter) are set one after another, in the order they were added. With
+    barrier=False, set() returns as soon as the sets have started; wait()
+    (or the next set()) waits for them. Any that fail are reported together
+    in a lock_failed.
     """
-    def __init__(self, locklist = None):
+    def __init__(self, locklist = None, parallel=True, max_workers=None, barrier=True):
         self.ready = False
         self.value = None
         self.locklist = locklist
         if self.locklist is None:
             self.locklist = []
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.barrier = barrier
+        self.pool = None
+        self.pending = []
 
     def append(self, lock):
         self.locklist.append(lock)
@@ -107,19 +316,110 @@ class lockable_parameter_t(parameter_t):
         else:
             return None
 
+    @staticmethod
+    def bus(lock):
+        # What a member's commands go through; members with the same one are set in turn
+        parent = getattr(lock, "parent", None)
+        if parent is None:
+            return lock
+        substrate = getattr(parent, "substrate", None) or getattr(parent, "gpib", None) or parent
+        # gpib_devices on one Prologix adapter (or gpib_bus) share its serial port
+        return getattr(substrate, "serial", substrate)
+
+    def groups(self):
+        groups = OrderedDict()
+        for l in self.locklist:
+            groups.setdefault(id(self.bus(l)), []).append(l)
+        return list(groups.values())
+
+    @staticmethod
+    def _set_group(group, value):
+        errors = []
+        for l in group:
+            try:
+                l.set(value)
+            except Exception as e:
+                errors.append((l, e))
+        return errors
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        errors = []
+        for f in pending:
+            errors.extend(f.result())
+        if errors:
+            raise lock_failed(errors)
+
     def set(self, value):
+        self.wait()
+        self.ready = True
+        self.value = value
+        groups = self.groups()
+        if not self.parallel or len(groups) < 2:
+            errors = self._set_group(self.locklist, value)
+            if errors:
+                raise lock_failed(errors)
+            return
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers or len(groups))
+        self.pending = [self.pool.submit(self._set_group, g, value) for g in groups]
+        if self.barrier:
+            self.wait()
+
+    async def aset(self, value):
         self.ready = True
         self.value = value
-        for l in self.locklist:
-            l.set(value)
 
-class frequency_t(parameter_t):
+        async def set_group(group):
+            errors = []
+            for l in group:
+                try:
+                    await l.aset(value)
+                except Exception as e:
+                    errors.append((l, e))
+            return errors
+
+        results = await asyncio.gather(*[set_group(g) for g in self.groups()])
+        errors = [e for r in results for e in r]
+        if errors:
+            raise lock_failed(errors)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+class wrapped_parameter_t(parameter_t):
+    # Adds units to another parameter; reads and writes go through it, so that it can memoize them
     def __init__(self, param):
         self.param = param
 
     def __getattr__(self, name):
         return getattr(self.param, name)
 
+    def query(self):
+        return self.param.query()
+
+    def get(self):
+        return self.param.get()
+
+    def set(self, value):
+        # Limits may have been put on this wrapper rather than on the parameter inside it
+        self.boundscheck(value)
+        self.param.set(value)
+
+    async def aquery(self):
+        return await self.param.aquery()
+
+    async def aget(self):
+        return await self.param.aget()
+
+    async def aset(self, value):
+        self.boundscheck(value)
+        await self.param.aset(value)
+
+class frequency_t(wrapped_parameter_t):
+
     @property
     def hz(self):
         return self.get()
@@ -140,7 +440,7 @@ class frequency_t(parameter_t):
     def mhz(self):
         return self.khz / 1000.0
 
-    @khz.setter
+    @mhz.setter
     def mhz(self, value):
         self.khz = value * 1000
 
@@ -152,12 +452,7 @@ class frequency_t(parameter_t):
     def ghz(self, value):
         self.mhz = value * 1000
 
-class timespan_t(parameter_t):
-    def __init__(self, param):
-        self.param = param
-
-    def __getattr__(self, name):
-        return getattr(self.param, name)
+class timespan_t(wrapped_parameter_t):
 
     @property
     def milliseconds(self):
@@ -121,10 +121,9 @@ class u2020_t(scpi_t):
         # I am fairly certain that all of the following is unnecessary.
         self.substrate.write("TRAC1:MEAS:TILT:UNIT PCT")
         self.substrate.write("TRIG1:DEL:AUTO 0")
-        for t in ["TRAC1:UNIT?", "TRAC1:STAT?", "TRAC1:DEF:TRAN:REF?", "TRAC1:DEF:DUR:REF?", "SENS1:BAND:VID?", "PST1:CCDF:DAT:MAX?", "SENS1:AVER?" ,
+        self.query_many(["TRAC1:UNIT?", "TRAC1:STAT?", "TRAC1:DEF:TRAN:REF?", "TRAC1:DEF:DUR:REF?", "SENS1:BAND:VID?", "PST1:CCDF:DAT:MAX?", "SENS1:AVER?" ,
                 "SENS1:AVER:COUN:AUTO?", "SENS1:AVER:COUN?", "SENS1:CORR:GAIN2:STAT?", "SENS1:CORR:GAIN2?", "SENS1:AVER:SDET?", "SENS1:FREQ?", "SENS1:AVER2:COUNT?", "SENS1:AVER2:STATE?",
-                "INIT1:CONT?", "TRIG1:DEL:AUTO?", "TRIG1:SOUR?", "OUTP:REC1:STAT?", "OUTP:REC1:LIM:LOW?", "SERV:BIST:VID:STAT?"]:
-            self.substrate.read(t)
+                "INIT1:CONT?", "TRIG1:DEL:AUTO?", "TRIG1:SOUR?", "OUTP:REC1:STAT?", "OUTP:REC1:LIM:LOW?", "SERV:BIST:VID:STAT?"])
         
         self.calibrate()
 
@@ -0,0 +1,59 @@
+
+# Helpers for taking SCPI program messages apart.
+
+vowels = "AEIOU"
+
+
+def short_form(keyword):
+    # "MEASure" -> "MEAS", "VOLTAGE" -> "VOLT", "frequency" -> "FREQ", "SOURce1" -> "SOUR1", "*idn" -> "*IDN"
+    if keyword.startswith("*"):
+        return keyword.upper()
+    stem = keyword.rstrip("0123456789")
+    suffix = keyword[len(stem):]
+    if stem.upper() != stem and stem.lower() != stem:
+        # Mixed case, as in the datasheets; the capitals are the short form
+        short = "".join(c for c in stem if c.isupper())
+        if stem.startswith(short):
+            return short + suffix
+    stem = stem.upper()
+    if len(stem) > 4:
+        stem = stem[:3] if stem[3] in vowels else stem[:4]
+    return stem + suffix
+
+
+def split_units(message):
+    # Splits a message on the semicolons between its units, ignoring any that are inside quotes
+    units = []
+    start = 0
+    quote = None
+    for i, c in enumerate(message):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c == ";":
+            units.append(message[start:i].strip())
+            start = i + 1
+    units.append(message[start:].strip())
+    return [u for u in units if u]
+
+
+def split_header(unit):
+    # Returns (header, arguments) for one message unit
+    parts = unit.strip().split(None, 1)
+    if not parts:
+        return "", ""
+    return parts[0], (parts[1].strip() if len(parts) > 1 else "")
+
+
+def normalize_header(command):
+    # The header of the first unit of a command, in upper case short form with any leading colon removed,
+    # so that "SOURce1:FREQuency 1e9; " and ":sour1:freq?" give "SOUR1:FREQ" and "SOUR1:FREQ?"
+    units = split_units(command)
+    if not units:
+        return ""
+    header, args = split_header(units[0])
+    query = header.endswith("?")
+    keywords = [short_form(k) for k in header.rstrip("?").lstrip(":").split(":") if k]
+    return ":".join(keywords) + ("?" if query else "")
@@ -4,6 +4,7 @@ import sys
 import os
 import time
 from dt_scpi_lib.ieee488 import ieee488_t, scpi_t
+from dt_scpi_lib.substrate import gpib_device, block_capture
 
 class sig_gen_t(ieee488_t):
     @property
@@ -123,7 +124,7 @@ class fake_sig_gen(sig_gen_t):
 class scpi_sig_gen(scpi_t):
     def __init__(self, substrate):
         super().__init__()
-        self.frequency = frequency_t(requerying_parameter_t(self, lambda hz: "SOUR1:FREQ %dHz; " % hz, getter="SOUR1:FREQ?"))
+        self.frequency = frequency_t(requerying_parameter_t(self, lambda hz: "SOUR1:FREQ %dHz; " % hz, getter="SOUR1:FREQ?", tolerance=1))
         self.substrate = substrate
         self.mrf_power = False
         self.power_level = memoizing_parameter_t(self, lambda db: "pow %f; " % db, getter="pow?")
@@ -155,29 +156,30 @@ class smbv100a(scpi_sig_gen):
             else:
                 return "%d ns" % int(ns)
 
-        self.gpib.write(":PULM:MODE SING")
-        self.gpib.write("PULM:PER %s" % durstr(period))
-        self.gpib.write("PULM:WIDT %s" % durstr(width))
-        self.gpib.write("PULM:STAT ON")
+        self.substrate.write(":PULM:MODE SING")
+        self.substrate.write("PULM:PER %s" % durstr(period))
+        self.substrate.write("PULM:WIDT %s" % durstr(width))
+        self.substrate.write("PULM:STAT ON")
 
     def continuous_wave(self):
-        self.gpib.write("PULM:STAT OFF") # turn off PWM.
-
-    def screenshot(self, filename):
-        self.gpib.write(":HCOPy:DEVice:LANGuage PNG")
-        self.gpib.write(":HCOPy:FILE:NAME:AUTO:STATe 1")
-        self.gpib.write(":HCOPy:REGion ALL")
-        self.gpib.write(":HCOPy:EXECute")
-        self.gpib.read(":HCOPy:FILE:AUTO:FILE?")
-        self.gpib.write(":HCOPy:DATA?")
-        data = self.gpib.readblock()
-        with open(filename, "w+b") as scrshot:
-            scrshot.write(data)
+        self.substrate.write("PULM:STAT OFF") # turn off PWM.
+
+    def screenshot(self, filename, background=False, callback=None):
+        # Streams the PNG to the file and returns the block_capture; with background=True, wait() for it
+        # before using the signal generator again
+        self.substrate.write(":HCOPy:DEVice:LANGuage PNG")
+        self.substrate.write(":HCOPy:FILE:NAME:AUTO:STATe 1")
+        self.substrate.write(":HCOPy:REGion ALL")
+        self.substrate.write(":HCOPy:EXECute")
+        self.substrate.read(":HCOPy:FILE:AUTO:FILE?")
+        self.substrate.write(":HCOPy:DATA?")
+        return block_capture(self.substrate, filename, callback, background)
 
     def save(self, slot):
-        self.gpib.write("*SAV %d" % slot)
+        self.substrate.write("*SAV %d" % slot)
     def recall(self, slot):
-        self.gpib.write("*RCL %d" % slot)
+        self.substrate.write("*RCL %d" % slot)
+        self.invalidate_state()
 
 class keysight_x_series(scpi_sig_gen):
     def __init__(self, substrate):
@@ -212,16 +214,16 @@ class smw200a(scpi_sig_gen):
     def continuous_wave(self):
         self.substrate.write("PULM:STAT OFF") # turn off PWM.
 
-    def screenshot(self, filename):
+    def screenshot(self, filename, background=False, callback=None):
+        # Streams the PNG to the file and returns the block_capture; with background=True, wait() for it
+        # before using the signal generator again
         self.substrate.write(":HCOPy:DEVice:LANGuage PNG")
         self.substrate.write(":HCOPy:FILE:NAME:AUTO:STATe 1")
         self.substrate.write(":HCOPy:REGion ALL")
         self.substrate.write(":HCOPy:EXECute")
         self.substrate.read(":HCOPy:FILE:AUTO:FILE?")
         self.substrate.write(":HCOPy:DATA?")
-        data = self.substrate.readblock()
-        with open(filename, "w+b") as scrshot:
-            scrshot.write(data)
+        return block_capture(self.substrate, filename, callback, background)
 
     def system_errors_all(self):
         return self.substrate.read(":SYSTem:ERRor:ALL?")
@@ -229,6 +231,7 @@ class smw200a(scpi_sig_gen):
         self.substrate.write("*SAV %d" % slot)
     def recall(self, slot):
         self.substrate.write("*RCL %d" % slot)
+        self.invalidate_state()
 
 class hp8648(sig_gen_t):
     def __init__(self, tty):
@@ -0,0 +1,282 @@
+from collections import namedtuple, deque
+import os
+import socket
+import threading
+import time
+import tty
+from dt_scpi_lib.substrate import fakelog
+from dt_scpi_lib.scpi_parse import split_units, split_header, normalize_header
+
+# A SCPI instrument simulator, for load-testing sequences and transports without hardware.
+#
+# sim_instrument is the engine: it keeps the instrument state, an error queue and the command handlers,
+# and works out how long each message would take on the real thing. It can be reached in-process
+# through sim_substrate, over TCP through sim_server (like a LAN instrument on port 5025), or through a
+# pseudo-terminal with sim_pty (like a usbtty, or a Prologix adapter with instruments at several addresses).
+
+
+class latency_model(object):
+    # per_command:      seconds of overhead for every message unit
+    # bytes_per_second: link speed, applied to both directions; None for infinitely fast
+    # settle:           extra seconds after particular commands, keyed by header, eg. {"SOUR:FREQ": 0.002}
+    # opc_delay:        how long "*OPC?" takes to answer after the last command that had a settle time
+    def __init__(self, per_command=0.0, bytes_per_second=None, settle=None, opc_delay=0.0):
+        self.per_command = per_command
+        self.bytes_per_second = bytes_per_second
+        self.settle = dict((normalize_header(k), v) for k, v in (settle or {}).items())
+        self.opc_delay = opc_delay
+
+    def transfer(self, nbytes):
+        if not self.bytes_per_second:
+            return 0.0
+        return nbytes / float(self.bytes_per_second)
+
+
+sim_error = namedtuple("sim_error", ["code", "message"])
+
+
+class sim_instrument(object):
+    # Anything without a handler is simulated generically: a command stores its arguments under its header,
+    # and the matching query returns them (or "0" if it was never set). With strict=True an unknown query
+    # puts -113 "Undefined header" on the error queue instead, and gets no answer, like a real instrument.
+    # Handlers are called as handler(instrument, arguments) and return None, a string, or bytes (sent as
+    # an IEEE block).
+    def __init__(self, idn="Devtank,Simulator,0,0", latency=None, strict=False):
+        self.idn = idn
+        self.latency = latency or latency_model()
+        self.strict = strict
+        self.lock = threading.RLock()
+        self.handlers = {}
+        self.rst()
+        self.handler("*IDN?", lambda inst, args: inst.idn)
+        self.handler("*RST", lambda inst, args: inst.rst())
+        self.handler("*CLS", lambda inst, args: inst.errors.clear())
+        self.handler("*OPC?", lambda inst, args: "1")
+        self.handler("*OPC", lambda inst, args: None)
+        self.handler("*WAI", lambda inst, args: None)
+        self.handler("*ESR?", lambda inst, args: "1" if not inst.errors else "32")
+        self.handler("SYSTem:ERRor?", lambda inst, args: inst.next_error())
+        self.handler("SYSTem:ERRor:NEXT?", lambda inst, args: inst.next_error())
+
+    def rst(self):
+        self.state = {}
+        self.errors = deque()
+        self.busy_until = 0.0
+
+    def handler(self, header, fn):
+        self.handlers[normalize_header(header)] = fn
+
+    def error(self, code, message):
+        self.errors.append(sim_error(code, message))
+
+    def next_error(self):
+        if not self.errors:
+            return '+0,"No error"'
+        e = self.errors.popleft()
+        return '%+d,"%s"' % (e.code, e.message)
+
+    def _unit(self, unit, path):
+        header, args = split_header(unit)
+        if path and not header.startswith((":", "*")):
+            # Relative to the previous unit in the same message, as the SCPI standard has it
+            header = path + ":" + header
+        name = normalize_header(header)
+        query = name.endswith("?")
+        if name in self.handlers:
+            return name, self.handlers[name](self, args)
+        if query:
+            key = name[:-1]
+            if key in self.state:
+                return name, self.state[key]
+            if self.strict:
+                self.error(-113, "Undefined header")
+                return name, None
+            return name, "0"
+        self.state[name] = args
+        return name, None
+
+    def execute(self, message):
+        # Returns (out, seconds): the bytes the message makes the instrument send back (or None), and how long
+        # that would take on the real instrument, including waiting for earlier operations if it's *OPC?
+        responses = []
+        seconds = self.latency.transfer(len(message))
+        path = ""
+        with self.lock:
+            now = time.monotonic()
+            for unit in split_units(message):
+                name, r = self._unit(unit, path)
+                if not name.startswith("*"):
+                    path = name.rstrip("?").rsplit(":", 1)[0] if ":" in name else ""
+                seconds += self.latency.per_command
+                settle = self.latency.settle.get(name.rstrip("?"), 0.0)
+                if settle:
+                    self.busy_until = max(self.busy_until, now + seconds + settle)
+                if name == "*OPC?":
+                    seconds = max(seconds, self.busy_until - now + self.latency.opc_delay)
+                if r is not None:
+                    responses.append(r)
+        if not responses:
+            return None, seconds
+        if len(responses) == 1 and isinstance(responses[0], (bytes, bytearray)):
+            header = str(len(responses[0])).encode()
+            out = b"#" + str(len(header)).encode() + header + bytes(responses[0]) + b"\n"
+        else:
+            out = (";".join(str(r) for r in responses) + "\n").encode()
+        return out, seconds + self.latency.transfer(len(out))
+
+
+class sim_substrate(object):
+    # In-process access to a sim_instrument, with the same interface as the other substrates.
+    # With realtime=False the latency model is ignored and everything answers immediately.
+    def __init__(self, instrument, log=None, realtime=True):
+        self.instrument = instrument
+        self.realtime = realtime
+        self.pending = deque()
+        self.log = log
+        if not self.log:
+            self.log = fakelog()
+
+    @property
+    def substrate(self):
+        return self
+
+    def close(self):
+        pass
+
+    def write(self, string):
+        self.log.command(string)
+        out, seconds = self.instrument.execute(string)
+        if self.realtime and seconds:
+            time.sleep(seconds)
+        if out is not None:
+            self.pending.append(out)
+
+    def _next(self):
+        if not self.pending:
+            raise RuntimeError("The simulated instrument has nothing to send")
+        return self.pending.popleft()
+
+    def readline(self):
+        r = self._next().decode().rstrip()
+        self.log.response(r)
+        return r
+
+    def read(self, string):
+        self.write(string)
+        return self.readline()
+
+    def readblock(self):
+        out = self._next()
+        digits = int(out[1:2])
+        length = int(out[2:2 + digits])
+        self.log.remark("Fetching a %u byte block" % length)
+        return bytearray(out[2 + digits:2 + digits + length])
+
+
+class _sim_link(object):
+    # Reads newline-terminated messages from a file descriptor or socket, and answers them from an instrument
+    def __init__(self, instrument, realtime):
+        self.instrument = instrument
+        self.realtime = realtime
+
+    def answer(self, message):
+        out, seconds = self.instrument.execute(message)
+        if self.realtime and seconds:
+            time.sleep(seconds)
+        return out
+
+    def serve(self, recv, send):
+        pending = b""
+        while True:
+            try:
+                data = recv()
+            except OSError:
+                return
+            if not data:
+                return
+            pending += data
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                out = self.handle(line.decode().strip())
+                if out:
+                    try:
+                        send(out)
+                    except OSError:
+                        return
+
+    def handle(self, message):
+        if not message:
+            return None
+        return self.answer(message)
+
+
+class sim_server(_sim_link):
+    # A raw-SCPI TCP server on 127.0.0.1; connect to it with socket_comm("127.0.0.1", server.port)
+    def __init__(self, instrument, port=0, realtime=True):
+        _sim_link.__init__(self, instrument, realtime)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", port))
+        self.listener.listen(4)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = threading.Thread(target=self._session, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _session(self, conn):
+        with conn:
+            self.serve(lambda: conn.recv(65536), conn.sendall)
+
+    def close(self):
+        self.listener.close()
+
+
+class sim_pty(_sim_link):
+    # Serves a pseudo-terminal; open sim.path with usbtty, or with prologix_tty if instrument is a dict of
+    # GPIB address to sim_instrument. Prologix "++" commands are understood as far as "++addr" goes, and
+    # otherwise ignored.
+    def __init__(self, instrument, realtime=True):
+        _sim_link.__init__(self, instrument, realtime)
+        self.addr = None
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, message):
+        if message.startswith("++"):
+            if message.startswith("++addr"):
+                self.addr = int(message.split()[1])
+            return None
+        if isinstance(self.instrument, dict):
+            if self.addr not in self.instrument:
+                return None
+            return _sim_link(self.instrument[self.addr], self.realtime).answer(message)
+        return _sim_link.handle(self, message)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self.master, view)
+            view = view[n:]
+
+    def _run(self):
+        self.serve(lambda: os.read(self.master, 65536), self._write)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
@@ -1,17 +1,48 @@
 from dt_scpi_lib.parameter import *
 from dt_scpi_lib.ieee488 import ieee488_t, scpi_t
+from dt_scpi_lib.substrate import gpib_device
+from dt_scpi_lib.batch import query_many
 
 from collections import namedtuple
 import sys
 import os
-import time
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def frequency_axis(centre, span, points):
+    # The frequency of each point of a trace, in Hz
+    start = centre - span / 2.0
+    if numpy is not None:
+        return numpy.linspace(start, start + span, points)
+    step = span / float(points - 1) if points > 1 else 0.0
+    return [start + i * step for i in range(points)]
+
+
+def big_endian_array(data, typecode):
+    # Binary trace data comes most significant byte first
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype=">" + {"H": "u2", "f": "f4"}[typecode])
+    a = array.array(typecode, bytes(data))
+    if sys.byteorder == "little":
+        a.byteswap()
+    return a
+
+class agilent_8563(ieee488_t):
+    # Not an IEEE-488.2 instrument (it doesn't understand *IDN? and the like), but wait_complete() works with "DONE?"
+    compound_queries = False
+    absolute_headers = False
 
-class agilent_8563(object):
     def __init__(self, serial):
         self.gpib = serial
-        self.centre_freq = frequency_t(memoizing_parameter_t(serial, lambda hz: "cf %.4f hz;" % hz))
-        self.freq_span = frequency_t(memoizing_parameter_t(serial, lambda hz: "sp %.4f hz;" % hz))
-        self.sweep_time = timespan_t(memoizing_parameter_t(serial, lambda ms: "st %.4f ms" % ms))
+        self.substrate = serial
+        self.centre_freq = frequency_t(memoizing_parameter_t(self, lambda hz: "cf %.4f hz;" % hz, getter="cf?;"))
+        self.freq_span = frequency_t(memoizing_parameter_t(self, lambda hz: "sp %.4f hz;" % hz, getter="sp?;"))
+        self.sweep_time = timespan_t(memoizing_parameter_t(self, lambda ms: "st %.4f ms" % ms))
         self.mres_band_width = 0
         self.mref_level = 0
         self.mdivider = 0
@@ -46,9 +77,10 @@ class agilent_8563(object):
     def divider(self, db):
         raise NotImplementedError
 
-    def do_sweep(self):
+    def do_sweep(self, timeout=10.0):
+        # DONE? answers once the sweep that TS started is over
         self.gpib.write("ts;")
-        time.sleep(self.msweep_time)
+        self.wait_complete("query", timeout, command="done?;")
 
     def marker_to_peak(self):
         self.gpib.write("mkpk nr;")
@@ -61,11 +93,39 @@ class agilent_8563(object):
                 return float(a)
 
     def reset(self):
+        # Instrument preset
         self.gpib.write("ip;")
-
-class e4440(object):
+        self.invalidate_state()
+
+    # A trace always has 601 points, each sent as two bytes in "measurement units" from 0 to 610; 600 is the top graticule line
+    trace_points = 601
+
+    def trace_units(self, trace="TRA"):
+        self.gpib.write("tdf b;%s?;" % trace)
+        return big_endian_array(self.gpib.read_raw(2 * self.trace_points), "H")
+
+    def trace(self, trace="TRA"):
+        # Returns (frequencies in Hz, amplitudes in dBm) for the whole of trace A (or "TRB"), in one transfer.
+        # On a linear amplitude scale (LG 0), the amplitudes are fractions of the reference level instead.
+        ref_level = float(self.gpib.read("rl?;"))
+        db_per_div = float(self.gpib.read("lg?;"))
+        units = self.trace_units(trace)
+        if db_per_div:
+            scale = lambda mu: ref_level + (mu - 600.0) * db_per_div / 60.0
+        else:
+            scale = lambda mu: mu / 600.0
+        if numpy is not None:
+            amplitudes = scale(units.astype(numpy.float64))
+        else:
+            amplitudes = [scale(mu) for mu in units]
+        centre = float(self.centre_freq.get())
+        span = float(self.freq_span.get())
+        return frequency_axis(centre, span, len(units)), amplitudes
+
+class e4440(ieee488_t):
     def __init__(self, serial):
         self.gpib = gpib_device(serial, 18)
+        self.substrate = self.gpib
         self.mcentre_frequency = 0
         self.msweep_time = 0
         self.mres_band_width = 0
@@ -106,7 +166,7 @@ class e4440(object):
 
     @freq_span.setter
     def freq_span(self, freq):
-        self.gpib.write("freq:cent %f GHz\n" % freq)
+        self.gpib.write("freq:span %f GHz\n" % freq)
         self.mfreq_span = freq
 
     @property
@@ -131,15 +191,24 @@ class e4440(object):
         self.mdivider = db
         self.gpib.write(":disp:wind:trac:y:pdiv %d db" % db)
 
-    def do_sweep(self):
-        # TODO: What is this?
-        raise NotImplementedError
+    def do_sweep(self, timeout=10.0):
+        # A single sweep, which has finished when *OPC? answers
+        self.gpib.write("init:cont off\n")
+        self.wait_complete("opc", timeout, command="init:imm;*opc?\n")
 
     def marker_to_peak(self):
-        # TODO: What is this?
-        raise NotImplementedError
+        self.gpib.write("calc:mark1:max\n")
 
     def read_marker(self):
-        # TODO: What is this?
-        raise NotImplementedError
-
+        return float(self.gpib.read("calc:mark1:y?\n"))
+
+    def trace(self, trace=1):
+        # Returns (frequencies in Hz, amplitudes in dBm) for a whole trace, as 32 bit floats in one block
+        self.gpib.write("form real,32;:form:bord norm\n")
+        self.gpib.write("trac:data? trace%u\n" % trace)
+        amplitudes = big_endian_array(self.gpib.readblock(), "f")
+        centre = self.mcentre_frequency * 1e9
+        span = self.mfreq_span * 1e9
+        if not span:
+            centre, span = [float(v) for v in query_many(self.gpib, ["freq:cent?", "freq:span?"])]
+        return frequency_axis(centre, span, len(amplitudes)), amplitudes
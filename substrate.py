@@ -5,12 +5,267 @@ import serial
 import time
 import socket
 import select
-from stat import *
 import fcntl
+import threading
+import contextlib
+import queue
+import atexit
 import datetime
+import io
+import errno
+import struct
+
+
+block_chunk_size = 1024 * 1024
+
+
+def ieee_block_length(read):
+    # Reads an IEEE 488.2 block header using read(n), and returns the length of the block that follows.
+    # '#0' is the indefinite length form, where the block runs until the final newline sent with END (EOI); in that
+    # case, None is returned.
+    c = read(1)
+    if c != b'#':
+        raise RuntimeError("The device did not respond with a valid IEEE block")
+    digits = int(read(1))
+    if digits == 0:
+        return None
+    header = read(digits)
+    if len(header) != digits:
+        raise RuntimeError("The IEEE block header was truncated")
+    return int(header)
+
+
+def read_definite_block(readinto, length, chunk_size=block_chunk_size):
+    # Fills a preallocated buffer in large chunks rather than growing a bytes object one byte at a time
+    data = bytearray(length)
+    view = memoryview(data)
+    got = 0
+    while got < length:
+        n = readinto(view[got:got + chunk_size])
+        if not n:
+            raise RuntimeError("The device stopped sending after %u of %u block bytes" % (got, length))
+        got += n
+    return data
+
+
+def read_indefinite_block(readinto1, chunk_size=block_chunk_size):
+    # A '#0' block is terminated by a newline sent with END, and the data can contain newlines of its own, so
+    # only the transport can tell where it ends: readinto1 must return 0 there. Transports that can't see END
+    # (serial lines, raw sockets) end the block when the instrument goes quiet, and document how long that is.
+    data = bytearray()
+    chunk = bytearray(chunk_size)
+    view = memoryview(chunk)
+    while True:
+        n = readinto1(view)
+        if not n:
+            break
+        data += view[:n]
+    if data.endswith(b"\n"):
+        del data[-1:]
+    return data
+
+
+class block_progress(object):
+    # How far a block transfer has got. callback, if given, is called with this object after every chunk.
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.length = None
+        self.done = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def start(self, length):
+        self.length = length
+        self.started = time.monotonic()
+
+    def update(self, count):
+        self.done += count
+        if self.callback:
+            self.callback(self)
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def fraction(self):
+        return self.done / float(self.length) if self.length else None
+
+    @property
+    def throughput(self):
+        # Bytes per second
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else None
+
+
+def copy_definite_block(readinto, length, out, progress, chunk_size=block_chunk_size):
+    # Like read_definite_block, but each chunk goes to out.write() as it arrives, through one reused buffer
+    chunk = bytearray(min(chunk_size, length) or 1)
+    view = memoryview(chunk)
+    got = 0
+    while got < length:
+        n = readinto(view[:min(chunk_size, length - got)])
+        if not n:
+            raise RuntimeError("The device stopped sending after %u of %u block bytes" % (got, length))
+        out.write(view[:n])
+        got += n
+        progress.update(n)
+
+
+def copy_indefinite_block(readinto1, out, progress, chunk_size=block_chunk_size):
+    # Like read_indefinite_block; the last byte of each chunk is held back, in case it's the final newline
+    chunk = bytearray(chunk_size + 1)
+    view = memoryview(chunk)
+    held = 0
+    while True:
+        n = readinto1(view[held:held + chunk_size])
+        if not n:
+            break
+        out.write(view[:held + n - 1])
+        progress.update(held + n - 1)
+        view[0] = view[held + n - 1]
+        held = 1
+    if held and view[0] != 0x0a:
+        out.write(view[:1])
+        progress.update(1)
+
+
+def serial_readinto1(port, quiet=None):
+    # A readinto1 for a pyserial port: waits for at least one byte, then takes whatever else has arrived.
+    # A serial line has no END, so this only returns 0 when nothing arrives for quiet seconds (or, without
+    # quiet, when the port's own read timeout runs out; with no timeout, a '#0' block never ends).
+    def readinto1(view):
+        if quiet is not None and not port.in_waiting:
+            r, w, e = select.select([ port ], [], [], quiet)
+            if not r:
+                return 0
+        data = port.read(max(1, min(port.in_waiting, len(view))))
+        view[:len(data)] = data
+        return len(data)
+    return readinto1
+
+
+def stream_block(read, readinto, out, progress, log, readinto1=None, chunk_size=block_chunk_size):
+    # Reads an IEEE block (header and all) with read/readinto, and copies it to out
+    length = ieee_block_length(read)
+    progress.start(length)
+    if length is None:
+        log.remark("Streaming a block of indefinite length")
+        copy_indefinite_block(readinto1 or readinto, out, progress, chunk_size)
+    else:
+        log.remark("Streaming a %u byte block" % length)
+        copy_definite_block(readinto, length, out, progress, chunk_size)
+    progress.finish()
+    log.remark("%u bytes in %.3f seconds" % (progress.done, progress.elapsed))
+    return progress
+
+
+def readblock_to(substrate, out, progress=None, chunk_size=block_chunk_size):
+    # Copies the block a substrate is about to send to a file object, a chunk at a time where the substrate can
+    # (it has a readblock_to method), and all at once where it can't.
+    if progress is None:
+        progress = block_progress()
+    if hasattr(substrate, "readblock_to"):
+        return substrate.readblock_to(out, progress, chunk_size)
+    data = substrate.readblock()
+    progress.start(len(data))
+    out.write(data)
+    progress.update(len(data))
+    progress.finish()
+    return progress
+
+
+class block_capture(object):
+    # Saves the block an instrument is about to send (the response to a query like :DISPlay:DATA? PNG) to a file.
+    # With background=True the copying is done by a thread, and the caller can get on with other instruments;
+    # this one's substrate mustn't be used again until wait() has returned. wait() returns the block_progress,
+    # or raises whatever went wrong.
+    def __init__(self, substrate, filename, callback=None, background=False, chunk_size=block_chunk_size):
+        self.substrate = substrate
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.progress = block_progress(callback)
+        self.error = None
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.run()
+
+    def run(self):
+        try:
+            with open(self.filename, "wb") as f:
+                readblock_to(self.substrate, f, self.progress, self.chunk_size)
+        except Exception as e:
+            self.error = e
+            if self.thread is None:
+                raise
+
+    @property
+    def done(self):
+        return self.progress.finished is not None or self.error is not None
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                raise substrate_timeout("The block capture to %s has not finished" % self.filename)
+        if self.error is not None:
+            raise self.error
+        return self.progress
+
+
+class substrate_timeout(TimeoutError):
+    pass
+
+
+class latency_counter(object):
+    # Running count/total/min/max of how long something took, in seconds
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.timeouts = 0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.minimum,
+            "max": self.maximum,
+            "timeouts": self.timeouts,
+        }
+
+
+def revelations(string):
+    return str(string).replace("\n", "\\n").replace("\r", "\\r")
+
+
+def format_record(tag, arrow, string):
+    return tag + arrow + "\"" + revelations(string) + "\""
 
 
 class base_log(object):
+    # Logs with enabled = False skip the formatting entirely
+    enabled = True
+
     def __init__(self, tag):
         self.tag = ((16 - len(tag[:16])) * " ") + tag
 
@@ -18,16 +273,22 @@ class base_log(object):
         raise NotImplementedError
 
     def revelations(self, string):
-        return str(string).replace("\n", "\\n").replace("\r", "\\r")
+        return revelations(string)
+
+    def record(self, arrow, string):
+        self.emit(format_record(self.tag, arrow, string))
 
     def command(self, string):
-        self.emit(self.tag + " >>> \"" + self.revelations(string) + "\"")
+        if self.enabled:
+            self.record(" >>> ", string)
 
     def remark(self, string):
-        self.emit(self.tag + " ... \"" + self.revelations(string) + "\"")
+        if self.enabled:
+            self.record(" ... ", string)
 
     def response(self, string):
-        self.emit(self.tag + " <<< \"" + self.revelations(string) + "\"")
+        if self.enabled:
+            self.record(" <<< ", string)
 
 
 class stdout_log(base_log):
@@ -36,6 +297,8 @@ class stdout_log(base_log):
 
 
 class fakelog(base_log):
+    enabled = False
+
     def __init__(self):
         base_log.__init__(self, tag="fake")
 
@@ -49,83 +312,426 @@ class stderr_log(stdout_log):
         sys.stderr.flush()
 
 
+class log_writer(object):
+    # A background thread that owns one buffered handle on a log file.
+    # Records are queued by the logging thread and formatted, batched and written by this one.
+    # The file is flushed every flush_interval seconds, and when it grows past max_bytes it is
+    # rotated to fn.1, fn.2 ... fn.<backups>.
+    def __init__(self, fn, flush_interval=1.0, max_bytes=None, backups=3):
+        self.fn = fn
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue()
+        self.file = open(fn, 'a', buffering=65536)
+        self.size = self.file.tell()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, item):
+        # item is either a preformatted line, or a (tag, arrow, string) tuple
+        self.queue.put(item)
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%u" % (self.fn, i)):
+                os.replace("%s.%u" % (self.fn, i), "%s.%u" % (self.fn, i + 1))
+        if self.backups:
+            os.replace(self.fn, self.fn + ".1")
+        self.file = open(self.fn, 'w', buffering=65536)
+        self.size = 0
+
+    def _run(self):
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                line = (item if isinstance(item, str) else format_record(*item)) + "\n"
+                self.file.write(line)
+                self.size += len(line)
+                if self.max_bytes and self.size >= self.max_bytes:
+                    self._rotate()
+            now = time.monotonic()
+            if not running or now - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = now
+        self.file.close()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
 class log(stdout_log):
-    def __init__(self, tag, fn):
+    # Appends to a file through one handle, kept open for the life of the log.
+    # With background=True the formatting and writing happen on a log_writer thread, shared by every
+    # background log on the same file; otherwise each line is written and flushed as it happens.
+    writers = {}
+
+    def __init__(self, tag, fn, background=False, flush_interval=1.0, max_bytes=None, backups=3):
         stdout_log.__init__(self, tag)
         self.fn = fn
-        open(fn, 'a').close() # Create the file if it doesn't exist
-        if S_ISSOCK(os.stat(fn).st_mode):
-            self.mode = 'a'
+        self.writer = None
+        self.file = None
+        if background:
+            key = os.path.abspath(fn)
+            if key not in log.writers:
+                log.writers[key] = log_writer(fn, flush_interval, max_bytes, backups)
+            self.writer = log.writers[key]
+        else:
+            self.file = open(fn, 'a')
+
+    def record(self, arrow, string):
+        if self.writer:
+            self.writer.put((self.tag, arrow, string))
         else:
-            self.mode = 'a'
+            self.emit(format_record(self.tag, arrow, string))
 
     def emit(self, string):
-        with open(self.fn, self.mode) as f:
-            f.write(string + '\n')
+        if self.writer:
+            self.writer.put(string)
+        else:
+            self.file.write(string + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
 
 
 class teelog(stdout_log):
     def __init__(self, loglist):
         self.loglist = loglist
         stdout_log.__init__(self, tag="tee")
+        self.enabled = any(l.enabled for l in loglist)
 
-    def emit(selF, string):
+    def emit(self, string):
         for l in self.loglist:
-            l.emit(string)
+            if l.enabled:
+                l.emit(string)
 
 
 class prologix_tty():
-    def __init__(self, f, log=None):
+    # read_tmo is how long the adapter waits for an instrument to start answering a "++read", in seconds.
+    # If it doesn't, the adapter sends nothing at all, and the read comes back as an empty string.
+    def __init__(self, f, log=None, metrics=None, read_tmo=0.5):
         self.file = serial.Serial(f)
         self.addr = None
+        self.name = f
+        self.metrics = metrics
+        self.probes = {}
+        self.read_tmo = read_tmo
         self.log = log
         if not self.log:
             self.log = fakelog()
-        for s in ["++mode 1", "++ifc", "++read_tmo_ms 500", "++eoi 1", "++eos 2"]:
+        for s in ["++mode 1", "++ifc", "++read_tmo_ms %u" % (read_tmo * 1000), "++eoi 1", "++eos 2"]:
             self.dwrite(s)
 
     def dwrite(self, string):
         self.log.command("\n" + string + "\n")
         self.file.write(("\n" + string + "\n").encode())
 
+    def probe(self, addr):
+        # One set of timings per GPIB address on this adapter
+        if addr not in self.probes:
+            self.probes[addr] = self.metrics.probe("%s@%s" % (self.name, addr))
+        return self.probes[addr]
+
     def write(self, addr, string):
-        if self.addr != addr:
+        started = time.perf_counter_ns()
+        self.select(addr)
+        data = string.encode()
+        self.file.write(data)
+        self.log.command(string)
+        if self.metrics:
+            self.probe(addr).sent(string, len(data), started)
+
+    def select(self, addr):
+        if addr is not None and self.addr != addr:
             self.dwrite("++addr %u" % addr)
             self.addr = addr
-        self.file.write(string.encode())
-        self.log.command(string)
 
-    def read_eoi(self):
-        self.dwrite("++read eoi")
-        a = self.file.readline().rstrip().decode()
+    def _read(self, addr, mode):
+        self.select(addr)
+        self.dwrite("++read " + mode)
+        # The port has no timeout of its own, since a long answer can take a while to come through; but if
+        # nothing has arrived by the time the adapter has given up, nothing will.
+        r, w, e = select.select([ self.file ], [], [], self.read_tmo + 0.1)
+        if not r:
+            self.log.remark("no answer within %g seconds" % self.read_tmo)
+            return ""
+        line = self.file.readline()
+        if self.metrics:
+            self.probe(self.addr).received(len(line))
+        a = line.rstrip().decode()
         self.log.response(a)
         return a
 
-    def read_lf(self):
-        self.dwrite("++read 10")
+    def read_eoi(self, addr=None):
+        return self._read(addr, "eoi")
+
+    def read_lf(self, addr=None):
+        return self._read(addr, "10")
+
+    def query(self, addr, string):
+        self.write(addr, string)
+        return self.read_eoi()
+
+    def spoll(self, addr=None):
+        # Serial poll: the instrument's status byte, without sending it a command
+        self.select(addr)
+        self.dwrite("++spoll")
         a = self.file.readline().rstrip().decode()
         self.log.response(a)
-        return a
+        return int(a)
+
+    def _skip_newline(self):
+        # The newline that ends the response after a block
+        if self.file.read(1) == b"\r":
+            self.file.read(1)
+
+    def readblock_to(self, addr, out, progress=None, chunk_size=block_chunk_size):
+        # The adapter passes whatever the instrument sends straight through, binary or not, until EOI
+        self.select(addr)
+        self.dwrite("++read eoi")
+        # The adapter doesn't pass EOI on, but it stops sending there, and it gives up on an instrument that
+        # pauses for longer than read_tmo; so once it has been quiet for longer than that, a '#0' block is over.
+        progress = stream_block(self.file.read, self.file.readinto, out, progress or block_progress(), self.log,
+                                readinto1=serial_readinto1(self.file, self.read_tmo + 0.1), chunk_size=chunk_size)
+        if progress.length is not None:
+            self._skip_newline()
+        if self.metrics:
+            self.probe(self.addr).received(progress.done)
+        return progress
+
+    def readblock(self, addr=None):
+        out = io.BytesIO()
+        self.readblock_to(addr, out)
+        return bytearray(out.getbuffer())
+
+    def read_raw(self, addr, count, more=False):
+        # For instruments that send binary data without a block header, such as the HP 8560 series after "TDF B".
+        # With more=True, reads the next count bytes of the same response (eg. after reading a header to get its length)
+        if not more:
+            self.select(addr)
+            self.dwrite("++read eoi")
+        data = bytearray(count)
+        got = self.file.readinto(data)
+        if got != count:
+            raise RuntimeError("The device sent %u of %u bytes" % (got, count))
+        self.log.remark("Read %u raw bytes" % count)
+        if self.metrics:
+            self.probe(self.addr).received(count)
+        return data
+
+
+class gpib_bus(object):
+    # Shares one prologix_tty between several threads.
+    # Each write, read or query is one transaction, and a thread can hold the bus for several
+    # transactions with "with bus.transaction(addr):". Threads queue for the bus, and when it
+    # frees up, a waiter for the address that is already selected goes first (up to max_run
+    # times in a row), which saves "++addr" switches; otherwise the oldest waiter goes next.
+    def __init__(self, tty, max_run=8):
+        self.tty = tty
+        self.log = tty.log
+        self.max_run = max_run
+        self.cond = threading.Condition()
+        self.pending = []
+        self.owner = None
+        self.depth = 0
+        self.seq = 0
+        self.run = 0
+        self.last_addr = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.cond:
+            self.started = time.monotonic()
+            self.busy_time = 0.0
+            self.transactions = 0
+            self.addr_switches = 0
+            self.wait_time = 0.0
+            self.max_queue = 0
+
+    def stats(self):
+        with self.cond:
+            elapsed = time.monotonic() - self.started
+            return {
+                "transactions": self.transactions,
+                "addr_switches": self.addr_switches,
+                "busy_seconds": self.busy_time,
+                "elapsed_seconds": elapsed,
+                "utilization": self.busy_time / elapsed if elapsed > 0 else 0.0,
+                "mean_wait_seconds": self.wait_time / self.transactions if self.transactions else 0.0,
+                "queued": len(self.pending),
+                "max_queued": self.max_queue,
+            }
+
+    def _next(self):
+        if self.run < self.max_run:
+            for ticket in self.pending:
+                if ticket[1] == self.tty.addr:
+                    return ticket
+        return self.pending[0]
+
+    def acquire(self, addr=None):
+        me = threading.current_thread()
+        with self.cond:
+            if self.owner is me:
+                self.depth += 1
+                return
+            queued = time.monotonic()
+            ticket = (self.seq, addr)
+            self.seq += 1
+            self.pending.append(ticket)
+            self.max_queue = max(self.max_queue, len(self.pending))
+            while self.owner is not None or self._next() is not ticket:
+                self.cond.wait()
+            self.pending.remove(ticket)
+            self.owner = me
+            self.depth = 1
+            self.granted = time.monotonic()
+            self.wait_time += self.granted - queued
+            if addr is not None and addr != self.tty.addr:
+                self.addr_switches += 1
+            if addr is not None and addr == self.last_addr:
+                self.run += 1
+            else:
+                self.run = 1
+            self.last_addr = addr
+
+    def release(self):
+        with self.cond:
+            self.depth -= 1
+            if self.depth:
+                return
+            self.busy_time += time.monotonic() - self.granted
+            self.transactions += 1
+            self.owner = None
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def transaction(self, addr=None):
+        self.acquire(addr)
+        try:
+            yield self.tty
+        finally:
+            self.release()
+
+    def dwrite(self, string):
+        with self.transaction():
+            self.tty.dwrite(string)
+
+    def write(self, addr, string):
+        with self.transaction(addr):
+            self.tty.write(addr, string)
+
+    def read_eoi(self, addr=None):
+        with self.transaction(addr):
+            return self.tty.read_eoi(addr)
+
+    def read_lf(self, addr=None):
+        with self.transaction(addr):
+            return self.tty.read_lf(addr)
+
+    def query(self, addr, string):
+        with self.transaction(addr):
+            return self.tty.query(addr, string)
+
+    def spoll(self, addr=None):
+        with self.transaction(addr):
+            return self.tty.spoll(addr)
+
+    def readblock_to(self, addr, out, progress=None, chunk_size=block_chunk_size):
+        with self.transaction(addr):
+            return self.tty.readblock_to(addr, out, progress, chunk_size)
+
+    def readblock(self, addr=None):
+        with self.transaction(addr):
+            return self.tty.readblock(addr)
+
+    def read_raw(self, addr, count, more=False):
+        with self.transaction(addr):
+            return self.tty.read_raw(addr, count, more)
+
 
 class gpib_device(object):
-    def __init__(self, substrate, address, eol="", log=None):
+    # The most that write_batch and query_many put in one message; older GPIB instruments have small input buffers
+    max_message = 256
+
+    def __init__(self, substrate, address, eol="", log=None, metrics=None):
         self.serial = substrate
         self.address = address
         self.log = log
         self.eol = eol
+        self.probe = metrics.probe(self._probe_name(substrate, address)) if metrics else None
         if not self.log:
             self.log = fakelog()
 
+    @staticmethod
+    def _probe_name(substrate, address):
+        # The same address on two adapters is two instruments, so it's named like prologix_tty's own timings
+        adapter = getattr(substrate, "name", None) or getattr(getattr(substrate, "tty", None), "name", None)
+        return "%s@%s" % (adapter, address) if adapter else "gpib%u" % address
+
     def write(self, string):
+        started = time.perf_counter_ns()
         self.log.command(string)
         self.serial.write(self.address, string + self.eol)
+        if self.probe:
+            self.probe.sent(string, len(string) + len(self.eol), started)
 
     def readline(self):
-        return self.serial.read_eoi()
+        a = self.serial.read_eoi(self.address)
+        if self.probe:
+            self.probe.received(len(a))
+        return a
 
     def read(self, string):
-        self.write(string)
-        return self.readline()
+        started = time.perf_counter_ns()
+        self.log.command(string)
+        a = self.serial.query(self.address, string + self.eol)
+        if self.probe:
+            self.probe.sent(string, len(string) + len(self.eol), started)
+            self.probe.received(len(a))
+        return a
+
+    def spoll(self):
+        return self.serial.spoll(self.address)
+
+    def readblock_to(self, out, progress=None, chunk_size=block_chunk_size):
+        return self.serial.readblock_to(self.address, out, progress, chunk_size)
+
+    def readblock(self):
+        return self.serial.readblock(self.address)
+
+    def read_raw(self, count, more=False):
+        a = self.serial.read_raw(self.address, count, more)
+        if self.probe:
+            self.probe.received(len(a))
+        return a
+
+    def transaction(self):
+        # Keeps other threads off a shared gpib_bus for the duration of a multi-step exchange
+        if hasattr(self.serial, "transaction"):
+            return self.serial.transaction(self.address)
+        return contextlib.nullcontext(self.serial)
 
 class dummy_substrate(object):
     def __init__(self, log=None):
@@ -165,6 +771,8 @@ class dummy_substrate(object):
 
 class usbtty(object):
     # A class that tries to behave exactly as does gpib_device above
+    max_message = 256
+
     def __init__(self, f, log=None):
         self.serial = serial.Serial(f)
         self.log = log
@@ -172,28 +780,73 @@ class usbtty(object):
             self.log = fakelog()
 
     def write(self, string):
-        self.log.command(cmd)
-        self.serial.write(string + "\n")
+        self.log.command(string)
+        self.serial.write((string + "\n").encode())
 
     def readline(self):
-        return self.serial.readline()
+        a = self.serial.readline().rstrip().decode()
+        self.log.response(a)
+        return a
 
     def read(self, string):
         self.write(string)
         return self.readline()
 
+    def readblock_to(self, out, progress=None, chunk_size=block_chunk_size):
+        progress = stream_block(self.serial.read, self.serial.readinto, out, progress or block_progress(), self.log,
+                                readinto1=serial_readinto1(self.serial), chunk_size=chunk_size)
+        if progress.length is not None and self.serial.read(1) == b"\r":
+            self.serial.read(1)
+        return progress
+
+    def readblock(self):
+        out = io.BytesIO()
+        self.readblock_to(out)
+        return bytearray(out.getbuffer())
+
+# From linux/usb/tmc.h: the usbtmc driver's read timeout, in milliseconds (no less than 100)
+USBTMC_IOCTL_GET_TIMEOUT = 0x80045b09
+USBTMC_IOCTL_SET_TIMEOUT = 0x40045b0a
+usbtmc_min_timeout_ms = 100
+
+
 class usbtmc(object):
     # Implements the USBTMC protocol
     # (Does not try to do anything to work around any quirks that various instruments might have)
+    max_message = 1024
 
-    def __init__(self, devpath, log=None, eol="\n", timeout=0):
+    def __init__(self, devpath, log=None, eol="\n", timeout=0, metrics=None, recv_size=65536):
         # The file needs to be opened as a binary file, and the strings need to be decoded and encoded.
         # Otherwise the slave device will claim that the query has been interrupted, will will cause the _raw_read method to time out.
         # I am not sure why this is.
-        self._dev = open(devpath, "r+b")
+        # timeout is in seconds and may be fractional; 0 means wait forever.
+        # devpath may also be a binary file object that is already open.
+        self._dev = devpath if hasattr(devpath, "readinto") else open(devpath, "r+b")
+        try:
+            self._fd = self._dev.fileno()
+        except (AttributeError, OSError, ValueError):
+            self._fd = None
+        # The usbtmc driver only asks the device for data when it is read, so poll()/select() can't tell that an
+        # answer is waiting; reads are bounded with the driver's own timeout instead. Anything else (such as a
+        # pseudo-terminal standing in for the device) is select()ed on.
+        self._driver_timeout = None
+        if self._fd is not None:
+            try:
+                self._driver_timeout = struct.unpack("=I", fcntl.ioctl(self._fd, USBTMC_IOCTL_GET_TIMEOUT, bytes(4)))[0]
+            except OSError:
+                pass
+        # Responses are read from the file descriptor into our own buffer, so that select() sees everything
+        # that hasn't been handed out yet; Python's file buffer would hide a second line that came in with the first.
+        self._rx = bytearray()
+        self._skip_terminator = False
+        self._eom = False
+        self._chunk = bytearray(recv_size)
+        self._chunk_view = memoryview(self._chunk)
         self._eol = eol
         self.log = log
         self.timeout = timeout
+        self.latency = latency_counter()
+        self.probe = metrics.probe(str(getattr(devpath, "name", devpath))) if metrics else None
         if not self.log:
             self.log = fakelog()
 
@@ -201,24 +854,128 @@ class usbtmc(object):
         self._dev.close()
 
     def _raw_write(self, cmd):
+        started = time.perf_counter_ns()
         self.log.command(cmd)
-        self._dev.write(cmd.encode() + self._eol.encode())
+        data = cmd.encode() + self._eol.encode()
+        self._dev.write(data)
         self._dev.flush()
+        if self.probe:
+            self.probe.sent(cmd, len(data), started)
+
+    def _deadline(self):
+        return time.monotonic() + self.timeout if self.timeout else None
+
+    def _recv_into(self, view, deadline):
+        # One read from the device (with the kernel driver, one transfer), straight into view.
+        # Without a file descriptor (eg. an in-memory file), there's nothing to wait on, so no timeout either.
+        if self._fd is None:
+            if not hasattr(self._dev, "read1"):
+                return self._dev.readinto(view)
+            # (BufferedRWPair.readinto1 can block on the pipe with data still sitting in its own buffer)
+            data = self._dev.read1(len(view))
+            view[:len(data)] = data
+            return len(data)
+        if self._driver_timeout is not None:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timed_out()
+                self._set_driver_timeout(max(int(remaining * 1000), usbtmc_min_timeout_ms))
+            try:
+                n = os.readv(self._fd, [ view ])
+            except OSError as e:
+                if e.errno == errno.ETIMEDOUT:
+                    self._timed_out()
+                raise
+            # The driver only returns less than was asked for at the end of the device's message (END)
+            self._eom = n < len(view)
+            return n
+        if deadline is not None:
+            # select() sleeps until the device has something for us, or until the deadline passes
+            r, w, e = select.select([ self._fd ], [], [], max(deadline - time.monotonic(), 0))
+            if not r:
+                self._timed_out()
+        return os.readv(self._fd, [ view ])
+
+    def _set_driver_timeout(self, ms):
+        if ms != self._driver_timeout:
+            fcntl.ioctl(self._fd, USBTMC_IOCTL_SET_TIMEOUT, struct.pack("=I", ms))
+            self._driver_timeout = ms
+
+    def _timed_out(self):
+        # (With no timeout of our own, the driver's default still applies)
+        seconds = self.timeout or self._driver_timeout / 1000.0
+        self.latency.timeouts += 1
+        self.log.remark("no response after %g seconds" % seconds)
+        raise substrate_timeout("The device did not respond within %g seconds" % seconds)
+
+    def _fill(self, deadline):
+        n = self._recv_into(self._chunk_view, deadline)
+        if not n:
+            raise RuntimeError("The device stopped sending")
+        self._rx += self._chunk_view[:n]
+
+    def _ensure(self, count):
+        while len(self._rx) < count:
+            self._fill(self._deadline())
+
+    def _read(self, count):
+        self._ensure(count)
+        data = bytes(self._rx[:count])
+        del self._rx[:count]
+        return data
+
+    def _drop_terminator(self):
+        # The newline that follows an IEEE block is left until the next read, which would wait for data anyway
+        if self._skip_terminator:
+            self._skip_terminator = False
+            self._ensure(1)
+            if self._rx.startswith(b"\r"):
+                self._ensure(2)
+                del self._rx[:1]
+            if self._rx.startswith(b"\n"):
+                del self._rx[:1]
+
+    def _readinto(self, view):
+        # Hands out what's already buffered first, then reads straight into view
+        got = min(len(view), len(self._rx))
+        if got:
+            view[:got] = self._rx[:got]
+            del self._rx[:got]
+            return got
+        return self._recv_into(view, self._deadline())
+
+    def _readinto_end(self, view):
+        # The readinto1 for '#0' blocks: returns 0 at the end of the message. The usbtmc driver shows where
+        # that is; a stand-in file descriptor (a pseudo-terminal, say) can't, so there it's 0.1 seconds of quiet.
+        if self._rx:
+            return self._readinto(view)
+        if self._fd is None:
+            return self._recv_into(view, None)
+        if self._driver_timeout is not None:
+            return 0 if self._eom else self._recv_into(view, self._deadline())
+        r, w, e = select.select([ self._fd ], [], [], 0.1)
+        return os.readv(self._fd, [ view ]) if r else 0
 
     def _raw_read(self):
-        if self.timeout == 0:
-            r = self._dev.readline().rstrip().decode()
-            self.log.response(r)
-            return r
-
-        for i in range(self.timeout):
-            r, w, e = select.select([ self._dev ], [], [], 0)
-            if self._dev in r:
-                r = self._dev.readline().rstrip().decode()
-                self.log.response(r)
-                return r
-            self.log.remark("time passes...")
-            time.sleep(1)
+        # The timeout is for the whole line, however many reads it takes
+        start = time.monotonic()
+        deadline = self._deadline()
+        self._drop_terminator()
+        searched = 0
+        i = self._rx.find(b"\n")
+        while i < 0:
+            searched = len(self._rx)
+            self._fill(deadline)
+            i = self._rx.find(b"\n", searched)
+        line = self._rx[:i + 1]
+        del self._rx[:i + 1]
+        self.latency.record(time.monotonic() - start)
+        if self.probe:
+            self.probe.received(len(line))
+        r = line.rstrip().decode()
+        self.log.response(r)
+        return r
 
     def write(self, cmd):
         self._raw_write(cmd)
@@ -227,6 +984,8 @@ class usbtmc(object):
         self.write(cmd)
         try:
             return self._raw_read()
+        except substrate_timeout:
+            raise
         except IOError as e:
             time.sleep(1)
             self.log.remark("retrying")
@@ -242,37 +1001,114 @@ class usbtmc(object):
         # then the length.
         # For example, if the block proper is 100 bytes long, then because 100 is a three digit number,
         # the header will be the five bytes; '#3100'
-        c = self._dev.read(1)
-        if c != b'#':
-            raise RuntimeError("The device did not respond with a valid IEEE block")
-        c = int(self._dev.read(1))
-        length = 0
-        for i in range(0, c):
-            length = length * 10 + int(self._dev.read(1))
-
-        self.log.remark("Fetching a block of length %u" % length)
-
-        data = b''
-        for i in range(0, length):
-            data += self._dev.read(1)
+        # The block comes back as a bytearray, so numpy.frombuffer() can wrap it without a copy.
+        self._drop_terminator()
+        length = ieee_block_length(self._read)
+        if length is None:
+            self.log.remark("Fetching a block of indefinite length")
+            data = read_indefinite_block(self._readinto_end)
+        else:
+            self.log.remark("Fetching a block of length %u" % length)
+            data = read_definite_block(self._readinto, length)
+            self._skip_terminator = True
+        if self.probe:
+            self.probe.received(len(data))
         return data
 
+    def readblock_to(self, out, progress=None, chunk_size=block_chunk_size):
+        self._drop_terminator()
+        progress = stream_block(self._read, self._readinto, out, progress or block_progress(), self.log,
+                                readinto1=self._readinto_end, chunk_size=chunk_size)
+        self._skip_terminator = progress.length is not None
+        if self.probe:
+            self.probe.received(progress.done)
+        return progress
+
 
 class socket_comm(object):
-    def __init__(self, host, port, log=None):
+    # Raw SCPI over TCP (usually port 5025).
+    # Everything received goes into one persistent buffer, so responses that arrive split across
+    # several segments, or several responses that arrive in one segment, are framed correctly.
+    # With coalesce=True, writes are held back and sent together just before the next read (or on flush()).
+    max_message = 4096
+
+    def __init__(self, host, port, log=None, timeout=5, recv_size=65536, coalesce=False, eol="\r\n", metrics=None):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
         self.sock.connect((host, port))
         self.log = log
         if not self.log:
             self.log = fakelog()
+        self.eol = eol.encode()
+        self.coalesce = coalesce
+        self.recv_size = recv_size
+        self._rx = bytearray()
+        self._tx = bytearray()
+        self._skip_terminator = False
+        self.probe = metrics.probe("%s:%u" % (host, port)) if metrics else None
+
+    @property
+    def recv_size(self):
+        return self._recv_size
+
+    @recv_size.setter
+    def recv_size(self, size):
+        self._recv_size = size
+        self._chunk = bytearray(size)
+        self._chunk_view = memoryview(self._chunk)
 
     def write(self, string):
+        started = time.perf_counter_ns()
         self.log.command(string)
-        self.sock.sendall((string+"\r\n").encode())
+        data = string.encode()
+        self._tx += data
+        self._tx += self.eol
+        if not self.coalesce or len(self._tx) >= self._recv_size:
+            self.flush()
+        if self.probe:
+            self.probe.sent(string, len(data) + len(self.eol), started)
+
+    def flush(self):
+        if self._tx:
+            self.sock.sendall(self._tx)
+            del self._tx[:]
+
+    def _fill(self):
+        n = self.sock.recv_into(self._chunk_view)
+        if n == 0:
+            raise ConnectionError("The instrument closed the connection")
+        self._rx += self._chunk_view[:n]
+
+    def _ensure(self, count):
+        self.flush()
+        while len(self._rx) < count:
+            self._fill()
+
+    def _drop_terminator(self):
+        # The newline that follows an IEEE block is left in the buffer until the next read asks for more data
+        if self._skip_terminator:
+            self._ensure(1)
+            if self._rx.startswith(b"\r"):
+                self._ensure(2)
+                del self._rx[:1]
+            if self._rx.startswith(b"\n"):
+                del self._rx[:1]
+            self._skip_terminator = False
 
     def readline(self):
-        string = self.sock.recv(1024).decode().rstrip()
+        self.flush()
+        self._drop_terminator()
+        start = 0
+        i = self._rx.find(b"\n")
+        while i < 0:
+            start = len(self._rx)
+            self._fill()
+            i = self._rx.find(b"\n", start)
+        string = self._rx[:i].decode().rstrip()
+        del self._rx[:i + 1]
+        if self.probe:
+            self.probe.received(i + 1)
         self.log.response(string)
         return string
 
@@ -280,18 +1116,83 @@ class socket_comm(object):
         self.write(string)
         return self.readline()
 
+    def _take(self, count):
+        data = self._rx[:count]
+        del self._rx[:count]
+        return bytes(data)
+
     def readblock(self):
-        # Gon read 1 kilobyte at a time
-        dat = self.sock.recv(1024)
-        i = int(dat[0].encode())
-        length = int(dat[1, 1+i])
+        self.flush()
+        self._drop_terminator()
+        length = ieee_block_length(lambda count: self._ensure(count) or self._take(count))
+        if length is None:
+            self.log.remark("Fetching a block of indefinite length")
+            data = self._read_indefinite_block()
+            if self.probe:
+                self.probe.received(len(data))
+            return data
+
         self.log.remark("Fetching a %u byte block" % length)
+        # Whatever is already buffered is copied once, and the rest is received straight into the result
+        data = bytearray(length)
+        view = memoryview(data)
+        got = min(length, len(self._rx))
+        view[:got] = self._rx[:got]
+        del self._rx[:got]
+        while got < length:
+            n = self.sock.recv_into(view[got:])
+            if n == 0:
+                raise ConnectionError("The instrument closed the connection after %u of %u block bytes" % (got, length))
+            got += n
+        self._skip_terminator = True
+        if self.probe:
+            self.probe.received(length)
+        return data
 
-        dat = dat[1+i:]
-        while len(dat) < length:
-            dat += self.sock.recv(1024)
+    def readblock_to(self, out, progress=None, chunk_size=block_chunk_size):
+        self.flush()
+        self._drop_terminator()
+        if progress is None:
+            progress = block_progress()
+        length = ieee_block_length(lambda count: self._ensure(count) or self._take(count))
+        progress.start(length)
+        if length is None:
+            self.log.remark("Streaming a block of indefinite length")
+            data = self._read_indefinite_block()
+            out.write(data)
+            progress.update(len(data))
+        else:
+            self.log.remark("Streaming a %u byte block" % length)
+            got = min(length, len(self._rx))
+            if got:
+                out.write(self._rx[:got])
+                del self._rx[:got]
+                progress.update(got)
+            copy_definite_block(self.sock.recv_into, length - got, out, progress, chunk_size)
+            self._skip_terminator = True
+        progress.finish()
+        if self.probe:
+            self.probe.received(progress.done)
+        return progress
 
-        return dat.decode()
+    def _read_indefinite_block(self):
+        # A raw socket has no END, and the data may contain newlines of its own, so a '#0' block runs until
+        # the instrument closes the connection or nothing arrives for the socket's timeout (with no timeout, only
+        # closing ends it). Each one costs a timeout; use definite length blocks where the instrument allows.
+        self._ensure(1)
+        while True:
+            try:
+                self._fill()
+            except (socket.timeout, ConnectionError):
+                break
+        data = bytearray(self._rx)
+        del self._rx[:]
+        if data.endswith(b"\r\n"):
+            del data[-2:]
+        elif data.endswith(b"\n"):
+            del data[-1:]
+        return data
 
     def close(self):
+        self.flush()
         self.sock.close()
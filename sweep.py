@@ -0,0 +1,175 @@
+from collections import namedtuple
+import concurrent.futures
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A frequency/power sweep engine, instead of a loop over frequency.hz and power_level.set in every script.
+#
+#   s = sweep_t(gen.frequency, lambda: meter.read(1), power=gen.power_level, settle=fixed_settle(0.005))
+#   result = s.run([1e9, 2e9, 3e9], powers=[-10, 0])
+#   result.values, result.timing["settle"]
+#
+# frequency and power are parameters, so a lockable_parameter_t can be used to retune several instruments
+# at once. Only the ones that change from one point to the next are set. Points go through the frequencies
+# at each power in turn, or can be given as a list of (frequency, power) pairs.
+#
+# The measurement is either a function that returns a reading, or an acquisition: a pair of functions, one
+# that takes the measurement (and returns when it's done, eg. INIT and *OPC?) and one that fetches the
+# result. With an acquisition and pipeline=True, fetching the result of one point is overlapped with
+# setting up and settling the next, which is only safe if the sensor and the source are on different buses.
+
+phases = ["set", "settle", "acquire", "fetch"]
+
+sweep_point = namedtuple("sweep_point", ["index", "frequency", "power", "value", "timing"])
+
+
+class acquisition(object):
+    def __init__(self, acquire, fetch):
+        self.acquire = acquire
+        self.fetch = fetch
+
+
+# Settle policies are called as policy(previous, point), with (frequency, power) pairs; previous is None
+# for the first point. They return once the source has settled.
+
+class fixed_settle(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, previous, point):
+        time.sleep(self.seconds)
+
+
+class step_settle(object):
+    # Waits longer for bigger steps: minimum seconds, plus so many per GHz and per dB of change, up to maximum.
+    # The first point gets the maximum, or the minimum if there isn't one.
+    def __init__(self, minimum=0.0, per_ghz=0.0, per_db=0.0, maximum=None):
+        self.minimum = minimum
+        self.per_ghz = per_ghz
+        self.per_db = per_db
+        self.maximum = maximum
+
+    def seconds(self, previous, point):
+        if previous is None:
+            return self.maximum if self.maximum is not None else self.minimum
+        s = self.minimum + abs(point[0] - previous[0]) / 1e9 * self.per_ghz
+        if point[1] is not None and previous[1] is not None:
+            s += abs(point[1] - previous[1]) * self.per_db
+        return s if self.maximum is None else min(s, self.maximum)
+
+    def __call__(self, previous, point):
+        s = self.seconds(previous, point)
+        if s > 0:
+            time.sleep(s)
+
+
+class opc_settle(object):
+    # Asks the instrument, which answers *OPC? once it has finished the settings it was given
+    def __init__(self, instrument):
+        self.instrument = instrument
+
+    def __call__(self, previous, point):
+        substrate = getattr(self.instrument, "substrate", None) or self.instrument.gpib
+        substrate.read("*OPC?")
+
+
+def _array(values):
+    if numpy is None:
+        return list(values)
+    return numpy.asarray(values)
+
+
+class sweep_result(object):
+    def __init__(self, points):
+        self.frequencies = _array([p.frequency for p in points])
+        self.powers = _array([p.power for p in points])
+        self.values = _array([p.value for p in points])
+        self.timing = dict((phase, _array([p.timing[phase] for p in points])) for phase in phases)
+
+    def summary(self):
+        # Total seconds spent in each phase; fetches that were overlapped with the next point count too
+        return dict((phase, float(sum(t))) for phase, t in self.timing.items())
+
+
+class sweep_t(object):
+    def __init__(self, frequency, measure, power=None, settle=None, pipeline=True):
+        self.frequency = frequency
+        self.power = power
+        self.measure = measure
+        self.settle = settle
+        self.pipeline = pipeline
+
+    @staticmethod
+    def grid(frequencies, powers=None):
+        if not powers:
+            return [(f, None) for f in frequencies]
+        return [(f, p) for p in powers for f in frequencies]
+
+    def _set(self, previous, point):
+        if previous is None or point[0] != previous[0]:
+            self.frequency.set(point[0])
+        if point[1] is not None and (previous is None or point[1] != previous[1]):
+            self.power.set(point[1])
+
+    def _timed_fetch(self):
+        started = time.perf_counter()
+        value = self.measure.fetch()
+        return value, time.perf_counter() - started
+
+    def points(self, frequencies=None, powers=None, points=None):
+        # Yields a sweep_point for each point as it is measured
+        if points is None:
+            points = self.grid(frequencies, powers)
+        split = isinstance(self.measure, acquisition)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=1) if split and self.pipeline else None
+        pending = None
+        previous = None
+        try:
+            for index, point in enumerate(points):
+                timing = dict((phase, 0.0) for phase in phases)
+                started = time.perf_counter()
+                self._set(previous, point)
+                timing["set"] = time.perf_counter() - started
+
+                started = time.perf_counter()
+                if self.settle is not None:
+                    self.settle(previous, point)
+                timing["settle"] = time.perf_counter() - started
+
+                if pending is not None:
+                    # The sensor has to finish handing over the last result before it can measure again
+                    yield self._finish(pending)
+                    pending = None
+
+                started = time.perf_counter()
+                if split:
+                    self.measure.acquire()
+                    timing["acquire"] = time.perf_counter() - started
+                    if pool is not None:
+                        pending = (index, point, timing, pool.submit(self._timed_fetch))
+                    else:
+                        value, timing["fetch"] = self._timed_fetch()
+                        yield sweep_point(index, point[0], point[1], value, timing)
+                else:
+                    value = self.measure()
+                    timing["acquire"] = time.perf_counter() - started
+                    yield sweep_point(index, point[0], point[1], value, timing)
+                previous = point
+            if pending is not None:
+                yield self._finish(pending)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    @staticmethod
+    def _finish(pending):
+        index, point, timing, future = pending
+        value, timing["fetch"] = future.result()
+        return sweep_point(index, point[0], point[1], value, timing)
+
+    def run(self, frequencies=None, powers=None, points=None):
+        return sweep_result(list(self.points(frequencies, powers, points)))
@@ -0,0 +1,326 @@
+from collections import namedtuple
+import os
+import struct
+import threading
+import time
+import heapq
+import contextlib
+from dt_scpi_lib.substrate import dummy_substrate, block_progress
+
+# Binary command/response traces.
+#
+# A trace is two files. The data file ("foo.trace") begins with a header, and then holds one record per
+# transaction: a fixed size entry followed by the raw bytes, stored verbatim. The index ("foo.trace.idx")
+# holds the same fixed size entries on their own, with each offset pointing at the bytes in the data file,
+# so a reader can find any transaction with one seek and scan millions of them for slow ones without
+# touching the payloads. Both files are only ever appended to.
+
+magic = b"DTTRACE1"
+file_header = struct.Struct("<8sdQ")        # magic, wall clock at start, monotonic_ns at start
+entry_format = struct.Struct("<QQQIHBx")    # start ns, duration ns, payload offset, payload length, tag id, direction
+
+TAG = 0      # payload is the name of a new tag; its id is the tag id of the entry
+WRITE = 1
+READ = 2
+BLOCK = 3
+RAW = 4      # binary data without a block header, from read_raw()
+POLL = 5     # a status byte from a serial poll, as a decimal string
+
+trace_entry = namedtuple("trace_entry", ["index", "start_ns", "duration_ns", "offset", "length", "tag", "direction"])
+
+
+def _payload(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return str(data).encode()
+
+
+class trace_file(object):
+    # The writing side. Several trace_recorder objects (one per instrument) can share one of these.
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.tags = {}
+        self.data = open(fn, "wb")
+        self.index = open(fn + ".idx", "wb")
+        self.data.write(file_header.pack(magic, time.time(), time.monotonic_ns()))
+        self.offset = file_header.size
+        self.count = 0
+
+    def _append(self, start_ns, duration_ns, tag_id, direction, payload):
+        entry = entry_format.pack(start_ns, duration_ns, self.offset + entry_format.size, len(payload), tag_id, direction)
+        self.data.write(entry)
+        self.data.write(payload)
+        self.index.write(entry)
+        self.offset += entry_format.size + len(payload)
+        self.count += 1
+
+    def tag_id(self, name):
+        with self.lock:
+            if name not in self.tags:
+                self.tags[name] = len(self.tags)
+                self._append(time.monotonic_ns(), 0, self.tags[name], TAG, name.encode())
+            return self.tags[name]
+
+    def append(self, tag_id, direction, start_ns, duration_ns, data):
+        payload = _payload(data)
+        with self.lock:
+            self._append(start_ns, duration_ns, tag_id, direction, payload)
+
+    def flush(self):
+        with self.lock:
+            self.data.flush()
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.data.close()
+            self.index.close()
+
+
+class trace_recorder(object):
+    # Wraps a substrate (anything with write/read/readline/readblock) and records every transaction.
+    # A query made with read() is recorded as a WRITE of the command at the moment the call started,
+    # followed by a READ of the response whose duration is the whole round trip. read_raw() and spoll() are
+    # recorded too, and so is everything done with the recorder handed out by transaction().
+    # Anything else is passed straight through to the wrapped substrate.
+    def __init__(self, substrate, trace, tag):
+        self.wrapped = substrate
+        self.trace = trace
+        self.tag = trace.tag_id(tag)
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped, name)
+        if name == "spoll":
+            # Only there if the wrapped substrate can poll, since callers fall back to *STB? if it can't
+            return self._spoll
+        return attr
+
+    @property
+    def substrate(self):
+        return self
+
+    def write(self, *args):
+        start = time.monotonic_ns()
+        r = self.wrapped.write(*args)
+        self.trace.append(self.tag, WRITE, start, time.monotonic_ns() - start, args[-1])
+        return r
+
+    def read(self, *args):
+        start = time.monotonic_ns()
+        r = self.wrapped.read(*args)
+        end = time.monotonic_ns()
+        self.trace.append(self.tag, WRITE, start, 0, args[-1])
+        self.trace.append(self.tag, READ, start, end - start, r)
+        return r
+
+    def readline(self, *args):
+        start = time.monotonic_ns()
+        r = self.wrapped.readline(*args)
+        self.trace.append(self.tag, READ, start, time.monotonic_ns() - start, r)
+        return r
+
+    def readblock(self, *args):
+        start = time.monotonic_ns()
+        r = self.wrapped.readblock(*args)
+        self.trace.append(self.tag, BLOCK, start, time.monotonic_ns() - start, r)
+        return r
+
+    def readblock_to(self, out, progress=None, chunk_size=None):
+        # The trace needs the whole block, so this one isn't streamed
+        progress = progress or block_progress()
+        data = self.readblock()
+        progress.start(len(data))
+        out.write(data)
+        progress.update(len(data))
+        progress.finish()
+        return progress
+
+    def read_raw(self, *args, **kwargs):
+        start = time.monotonic_ns()
+        r = self.wrapped.read_raw(*args, **kwargs)
+        self.trace.append(self.tag, RAW, start, time.monotonic_ns() - start, r)
+        return r
+
+    def _spoll(self, *args):
+        start = time.monotonic_ns()
+        r = self.wrapped.spoll(*args)
+        self.trace.append(self.tag, POLL, start, time.monotonic_ns() - start, r)
+        return r
+
+    @contextlib.contextmanager
+    def transaction(self, *args):
+        # Holds the wrapped substrate's bus, and hands back the recorder so that what's done inside is recorded too
+        transaction = getattr(self.wrapped, "transaction", None)
+        with (transaction(*args) if transaction else contextlib.nullcontext()):
+            yield self
+
+
+class trace_reader(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.data = open(fn, "rb")
+        self.index = open(fn + ".idx", "rb")
+        m, self.wall_start, self.monotonic_start = file_header.unpack(self.data.read(file_header.size))
+        if m != magic:
+            raise RuntimeError("%s is not a trace file" % fn)
+        self.tags = {}
+        for e in self.entries():
+            if e.direction == TAG:
+                self.tags[e.tag] = bytes(self.payload(e)).decode()
+
+    def __len__(self):
+        return os.fstat(self.index.fileno()).st_size // entry_format.size
+
+    def entry(self, i):
+        self.index.seek(i * entry_format.size)
+        return trace_entry(i, *entry_format.unpack(self.index.read(entry_format.size)))
+
+    def entries(self, chunk=65536):
+        # Walks the index in large reads; the payloads are not touched
+        self.index.seek(0)
+        i = 0
+        while True:
+            buf = self.index.read(chunk * entry_format.size)
+            if not buf:
+                return
+            for fields in entry_format.iter_unpack(buf[:len(buf) - len(buf) % entry_format.size]):
+                yield trace_entry(i, *fields)
+                i += 1
+
+    def payload(self, e):
+        self.data.seek(e.offset)
+        return self.data.read(e.length)
+
+    def transactions(self):
+        # (tag name, direction, start_ns, duration_ns, raw bytes) for everything but the tag definitions
+        for e in self.entries():
+            if e.direction != TAG:
+                yield self.tags[e.tag], e.direction, e.start_ns, e.duration_ns, self.payload(e)
+
+    def slowest(self, n=10):
+        return heapq.nlargest(n, (e for e in self.entries() if e.direction != TAG), key=lambda e: e.duration_ns)
+
+    def find_time(self, ns):
+        # Index of the first entry starting at or after ns (on the monotonic clock)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid).start_ns < ns:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+divergence = namedtuple("divergence", ["position", "expected", "got"])
+
+
+class replay_substrate(dummy_substrate):
+    # Answers a driver from a recorded trace instead of an instrument.
+    # Writes are checked against the recording; a write that doesn't match is reported as a divergence,
+    # and the replay looks up to `lookahead` transactions ahead for the command to pick up from there.
+    # With realtime=True every transaction takes as long as it did when it was recorded; otherwise the
+    # replay runs as fast as it can. With strict=True a divergence raises RuntimeError instead.
+    def __init__(self, fn, tag=None, realtime=False, strict=False, lookahead=16, log=None):
+        dummy_substrate.__init__(self, log)
+        reader = trace_reader(fn)
+        try:
+            self.script = [(direction, payload, duration) for t, direction, start, duration, payload in reader.transactions()
+                           if tag is None or t == tag]
+        finally:
+            reader.close()
+        self.polled = any(direction == POLL for direction, payload, duration in self.script)
+        self.position = 0
+        self.realtime = realtime
+        self.strict = strict
+        self.lookahead = lookahead
+        self.divergences = []
+
+    @property
+    def remaining(self):
+        return len(self.script) - self.position
+
+    def _diverge(self, position, expected, got):
+        d = divergence(position, expected, got)
+        self.divergences.append(d)
+        self.log.remark("diverged from the recording at %u: expected %r, got %r" % d)
+        if self.strict:
+            raise RuntimeError("Replay diverged at transaction %u: expected %r, got %r" % d)
+
+    def _take(self, directions):
+        if self.position >= len(self.script):
+            return None
+        direction, payload, duration = self.script[self.position]
+        if direction not in directions:
+            return None
+        self.position += 1
+        if self.realtime and duration:
+            time.sleep(duration / 1e9)
+        return payload
+
+    def write(self, *args):
+        string = args[-1]
+        self.log.command(string)
+        wanted = _payload(string)
+        position = self.position
+        recorded = self._take((WRITE,))
+        if recorded == wanted:
+            return
+        self._diverge(position, recorded, wanted)
+        if recorded is None:
+            # Perhaps the driver skipped a read; look for the command further on
+            start = self.position
+        else:
+            start = self.position - 1
+        for i in range(start, min(start + self.lookahead, len(self.script))):
+            if self.script[i][0] == WRITE and self.script[i][1] == wanted:
+                self.position = i + 1
+                return
+
+    def readline(self):
+        recorded = self._take((READ,))
+        if recorded is None:
+            self._diverge(self.position, self.script[self.position][1] if self.remaining else None, "readline")
+            return dummy_substrate.readline(self)
+        r = recorded.decode()
+        self.log.response(r)
+        return r
+
+    def readblock(self):
+        recorded = self._take((BLOCK,))
+        if recorded is None:
+            self._diverge(self.position, self.script[self.position][1] if self.remaining else None, "readblock")
+            return bytearray()
+        return bytearray(recorded)
+
+    def read_raw(self, count, more=False):
+        recorded = self._take((RAW,))
+        if recorded is None:
+            self._diverge(self.position, self.script[self.position][1] if self.remaining else None, "read_raw")
+            return bytearray(count)
+        return bytearray(recorded)
+
+    def __getattr__(self, name):
+        # Like the recorded substrate, this can only poll if polls were recorded
+        if name == "spoll" and self.__dict__.get("polled"):
+            return self._spoll
+        raise AttributeError(name)
+
+    def _spoll(self):
+        recorded = self._take((POLL,))
+        if recorded is None:
+            self._diverge(self.position, self.script[self.position][1] if self.remaining else None, "spoll")
+            return 0
+        return int(recorded)
+
+    def transaction(self):
+        return contextlib.nullcontext(self)
+
+    def read(self, *args):
+        self.write(*args)
+        return self.readline()
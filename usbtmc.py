@@ -27,6 +27,7 @@ THE SOFTWARE.
 import usb.core
 import usb.util
 import struct
+import array
 import time
 import os
 import re
@@ -72,6 +73,11 @@ USBTMC_HEADER_SIZE = 12
 
 RIGOL_QUIRK_PIDS = [0x04ce, 0x0588]
 
+# precompiled bulk message headers (msgid, btag, ~btag, transfer size, attributes[, term char])
+DEV_DEP_MSG_OUT_HEADER = struct.Struct('<BBBxLBxxx')
+DEV_DEP_MSG_IN_REQUEST = struct.Struct('<BBBxLBBxx')
+DEV_DEP_MSG_IN_HEADER  = struct.Struct('<BBBxLBxxx')
+
 
 def parse_visa_resource_string(resource_string):
     # valid resource strings:
@@ -282,6 +288,9 @@ class Instrument(object):
         self.rigol_quirk = False
         self.rigol_quirk_ieee_block = False
 
+        self.metrics = None
+        self.probe = None
+
         resource = None
 
         # process arguments
@@ -312,6 +321,9 @@ class Instrument(object):
                 self.term_char = val
             elif op == 'resource':
                 resource = val
+            elif op == 'metrics':
+                # a metrics.command_metrics object, to time each command
+                self.metrics = val
 
         if resource is not None:
             res = parse_visa_resource_string(resource)
@@ -335,6 +347,9 @@ class Instrument(object):
                 if self.device is None:
                     raise UsbtmcException("Device not found", 'init')
 
+        if self.metrics is not None:
+            self.probe = self.metrics.probe("USB::0x%04x::0x%04x::%s" % (self.idVendor or 0, self.idProduct or 0, self.iSerial or ""))
+
     def __del__(self):
         if self.connected:
             self.close()
@@ -570,7 +585,7 @@ class Instrument(object):
 
     # message header management
     def pack_bulk_out_header(self, msgid):
-        self.last_btag = btag = (self.last_btag % 255) + 1
+        btag = self.next_btag()
         return struct.pack('BBBx', msgid, btag, ~btag & 0xFF)
 
     def pack_dev_dep_msg_out_header(self, transfer_size, eom = True):
@@ -609,28 +624,51 @@ class Instrument(object):
         data = data[USBTMC_HEADER_SIZE:transfer_size+USBTMC_HEADER_SIZE]
         return (msgid, btag, btaginverse, transfer_size, transfer_attributes, data)
 
+    def next_btag(self):
+        self.last_btag = btag = (self.last_btag % 255) + 1
+        return btag
+
+    def _transfer_buffer(self, name, size, exact=False):
+        # Packet buffers are kept between transfers, so a steady stream of transfers allocates nothing.
+        # Bulk-IN packet buffers must be exactly the requested size, since pyusb reads len(buffer) bytes.
+        buf = getattr(self, name, None)
+        if buf is None or len(buf) < size or (exact and len(buf) != size):
+            buf = array.array('B', bytes(size))
+            setattr(self, name, buf)
+        return buf
+
     def write_raw(self, data):
         "Write binary data to instrument"
+        self.write_raw_from(memoryview(data))
+
+    def write_raw_from(self, data):
+        "Write binary data to instrument from any buffer (bytes, bytearray, memoryview, numpy array) without copying it first"
 
         if not self.connected:
             self.open()
 
-        eom = False
+        view = memoryview(data).cast('B')
+        num = len(view)
+        if num == 0:
+            return
 
-        num = len(data)
+        packet = self._transfer_buffer('_out_packet', USBTMC_HEADER_SIZE + min(num, self.max_transfer_size) + 3)
+        pview = memoryview(packet)
 
         offset = 0
 
         try:
             while num > 0:
-                if num <= self.max_transfer_size:
-                    eom = True
+                eom = num <= self.max_transfer_size
+                size = min(num, self.max_transfer_size)
+                pad = (4 - (size % 4)) % 4
+                btag = self.next_btag()
 
-                block = data[offset:offset+self.max_transfer_size]
-                size = len(block)
-
-                req = self.pack_dev_dep_msg_out_header(size, eom) + block + b'\0'*((4 - (size % 4)) % 4)
-                self.bulk_out_ep.write(req, timeout=self._timeout_ms)
+                DEV_DEP_MSG_OUT_HEADER.pack_into(packet, 0, USBTMC_MSGID_DEV_DEP_MSG_OUT, btag, ~btag & 0xFF, size, eom)
+                end = USBTMC_HEADER_SIZE + size
+                pview[USBTMC_HEADER_SIZE:end] = view[offset:offset+size]
+                pview[end:end+pad] = b'\0\0\0'[:pad]
+                self.bulk_out_ep.write(pview[:end+pad], timeout=self._timeout_ms)
 
                 offset += size
                 num -= size
@@ -641,6 +679,84 @@ class Instrument(object):
                 self._abort_bulk_out()
             raise
 
+    def read_raw_into(self, buffer):
+        "Read binary data from instrument into a preallocated writable buffer, and return the number of bytes read"
+
+        if not self.connected:
+            self.open()
+
+        out = memoryview(buffer).cast('B')
+        size = len(out)
+        if size == 0:
+            return 0
+
+        read_len = min(self.max_transfer_size, size)
+
+        term_char = 0
+        attributes = 0
+        if self.term_char is not None:
+            term_char = self.term_char
+            attributes = 2
+
+        request = self._transfer_buffer('_in_request', USBTMC_HEADER_SIZE)
+        packet = self._transfer_buffer('_in_packet', read_len+USBTMC_HEADER_SIZE+3, exact=True)
+        pview = memoryview(packet)
+
+        got = 0
+        transfer_size = None
+        eom = False
+
+        try:
+            while not eom and got < size:
+                first = transfer_size is None
+
+                if not self.rigol_quirk or first:
+
+                    # if the rigol sees this again, it will restart the transfer
+                    # so only send it the first time
+
+                    btag = self.next_btag()
+                    DEV_DEP_MSG_IN_REQUEST.pack_into(request, 0, USBTMC_MSGID_REQUEST_DEV_DEP_MSG_IN, btag, ~btag & 0xFF,
+                                                     min(read_len, size - got), attributes, term_char)
+                    self.bulk_out_ep.write(request, timeout=self._timeout_ms)
+
+                n = self.bulk_in_ep.read(packet, timeout=self._timeout_ms)
+
+                if self.rigol_quirk and not first:
+                    # the packet has no header if it isn't the first
+                    data = pview[:n]
+                else:
+                    msgid, btag, btaginverse, transfer_size, transfer_attributes = DEV_DEP_MSG_IN_HEADER.unpack_from(packet)
+                    data = pview[USBTMC_HEADER_SIZE:min(n, USBTMC_HEADER_SIZE+transfer_size)]
+
+                    if self.rigol_quirk and self.rigol_quirk_ieee_block and data[:1] == b"#":
+                        # ieee block incoming, the transfer_size usbtmc header is lying about the transaction size
+                        l = int(chr(data[1]))
+                        transfer_size = int(bytes(data[2:l+2])) + (l+2)  # account for ieee header
+
+                if self.rigol_quirk:
+                    # rigol devices lie about whether the transaction is complete
+                    count = min(len(data), transfer_size - got, size - got)
+                    eom = got + count >= transfer_size
+                else:
+                    count = min(len(data), size - got)
+                    eom = transfer_attributes & 1
+
+                out[got:got+count] = data[:count]
+                got += count
+
+                # Advantest devices never signal EOI and may only send one read packet
+                if self.advantest_quirk:
+                    break
+        except usb.core.USBError:
+            exc = sys.exc_info()[1]
+            if exc.errno == 110:
+                # timeout, abort transfer
+                self._abort_bulk_in()
+            raise
+
+        return got
+
     def read_raw(self, num=-1):
         "Read binary data from instrument"
 
@@ -658,7 +774,7 @@ class Instrument(object):
         if self.term_char is not None:
             term_char = self.term_char
 
-        read_data = b''
+        read_data = bytearray()
 
         try:
             while not eom:
@@ -724,7 +840,7 @@ class Instrument(object):
                 self._abort_bulk_in()
             raise
 
-        return read_data
+        return bytes(read_data)
 
     def ask_raw(self, data, num=-1):
         "Write then read binary data"
@@ -747,11 +863,18 @@ class Instrument(object):
                 self.write(message_i, encoding)
             return
 
-        self.write_raw(str(message).encode(encoding))
+        started = time.perf_counter_ns()
+        data = str(message).encode(encoding)
+        self.write_raw(data)
+        if self.probe:
+            self.probe.sent(str(message), len(data), started)
 
     def read(self, num=-1, encoding='utf-8'):
         "Read string from instrument"
-        return self.read_raw(num).decode(encoding).rstrip('\r\n')
+        data = self.read_raw(num)
+        if self.probe:
+            self.probe.received(len(data))
+        return data.decode(encoding).rstrip('\r\n')
 
     def ask(self, message, num=-1, encoding='utf-8'):
         "Write then read string"
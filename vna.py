@@ -4,17 +4,30 @@ from dt_scpi_lib.parameter import *
 import sys
 import os
 import time
+import array
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class hp8720d(ieee488_t):
+    # HP-IB commands rather than SCPI, and each answer comes back on a line of its own
+    compound_queries = False
+    absolute_headers = False
+
     def __init__(self, f):
         self.gpib = f
+        self.substrate = f
         self.mpower_level = 0
         self.gpib.write("*RST;")
+        self.invalidate_state()
         self.gpib.write("DEBU1;") # debugging info on VNA's screen
        # self.gpib.read("OPC?;PRES;CHAN2;REFP9;")
         #self.gpib.read("OPC?;SING;")
-        self.start_freq = frequency_t(memoizing_parameter_t(f, lambda hz: "STAR%d HZ;" % hz))
-        self.stop_freq = frequency_t(memoizing_parameter_t(f, lambda hz: "STOP%d HZ;" % hz))
+        self.start_freq = frequency_t(memoizing_parameter_t(self, lambda hz: "STAR%d HZ;" % hz, getter="STAR?;"))
+        self.stop_freq = frequency_t(memoizing_parameter_t(self, lambda hz: "STOP%d HZ;" % hz, getter="STOP?;"))
         self.start_freq.maximum = 20000000000
         self.start_freq.minimum = 50000000
         self.stop_freq.maximum = 20000000000
@@ -34,6 +47,8 @@ class hp8720d(ieee488_t):
 
     @property
     def sweep_pnt_count(self):
+        if not hasattr(self, "msweep_pnt_count"):
+            self.msweep_pnt_count = int(float(self.gpib.read("POIN?;")))
         return self.msweep_pnt_count
 
     @sweep_pnt_count.setter
@@ -69,11 +84,49 @@ class hp8720d(ieee488_t):
     def serial_number(self):
         return self.gpib.read("outpsern;")
 
-    def do_sweep(self):
-        self.gpib.write("REST;")
+    def do_sweep(self, timeout=10.0):
+        # A single sweep; OPC? answers once it is over
+        self.wait_complete("opc", timeout, command="OPC?;SING;")
 
     def get_sweep(self):
-        debug_print("Raw offsets: %s" % self.gpib.read("rawoffs?;"))
+        return self.trace()
+
+    # Binary transfer formats: IEEE 754 floats, 32 bit (FORM2) or 64 bit (FORM3), most significant byte first
+    form2 = 2
+    form3 = 3
+
+    def stimulus(self):
+        # The frequency of each point of a linear sweep, in Hz
+        start = float(self.start_freq.get())
+        stop = float(self.stop_freq.get())
+        points = self.sweep_pnt_count
+        if numpy is not None:
+            return numpy.linspace(start, stop, points)
+        step = (stop - start) / (points - 1) if points > 1 else 0.0
+        return [start + i * step for i in range(points)]
+
+    def read_trace(self, output="OUTPDATA", form=3):
+        # One transfer for the whole trace: "#A", a two byte length, then a (real, imaginary) pair for every point.
+        # OUTPDATA is the error corrected data; OUTPFORM is as displayed (for log magnitude, say, the imaginary parts are 0).
+        with self.gpib.transaction():
+            self.gpib.write("FORM%u;%s;" % (form, output))
+            header = self.gpib.read_raw(4)
+            if header[:2] != b"#A":
+                raise RuntimeError("The network analyser did not respond with a FORM%u block" % form)
+            length = struct.unpack(">H", header[2:])[0]
+            data = self.gpib.read_raw(length, more=True)
+        if numpy is not None:
+            values = numpy.frombuffer(data, dtype=">f4" if form == self.form2 else ">f8")
+            return values[0::2] + 1j * values[1::2]
+        values = array.array("f" if form == self.form2 else "d", bytes(data))
+        if sys.byteorder == "little":
+            values.byteswap()
+        return [complex(re, im) for re, im in zip(values[0::2], values[1::2])]
+
+    def trace(self, formatted=False, form=3):
+        # Returns (frequencies in Hz, complex values) for the active channel
+        values = self.read_trace("OUTPFORM" if formatted else "OUTPDATA", form)
+        return self.stimulus(), values
 
     def rf_power(self, enable):
         self.mrf_power = enable